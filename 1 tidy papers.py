@@ -1,9 +1,20 @@
+from concurrent.futures import ThreadPoolExecutor
+import argparse
+import json
+import time
 import os
 import shutil
 
+from instrumentation import Instrumentation
+from file_tools import save_json, cached_sha1, temporary_path_for
+
 user_path = "_User files"
 tidy_path = os.path.join(user_path, "papers")  # this is the local folder where tidied papers go
 untidy_papers_path = os.path.join(user_path, "untidy papers")  # place untidy IB papers here
+tidy_index_path = os.path.join(user_path, "tidy_index.json")  # remembers file hashes between runs, see load_tidy_index
+
+tidy_workers = 8  # files hashed and copied at once. Mostly waiting on the disk, so more than the cpu count is fine
+ficlone = 0x40049409  # the Linux ioctl that asks for a reflink copy, see reflink
 
 
 class Paper:
@@ -31,27 +42,176 @@ class Paper:
         self.name = raw_name.replace("__", "_")
 
 
-def get_all_paper_paths(untidy_papers=untidy_papers_path):
+def get_all_paper_paths(untidy_papers=untidy_papers_path, stats=None):
+    stats = stats or Instrumentation()  # see instrumentation.py, does nothing unless switched on
     papers = []
-    list_dirs = os.walk(untidy_papers)
-    for root, dirs, files in list_dirs:
-        for f in files:
-            full_path = os.path.join(root, f)
-            papers.append(full_path)
+    with stats.stage("walk"):
+        list_dirs = os.walk(untidy_papers)
+        for root, dirs, files in list_dirs:
+            for f in files:
+                full_path = os.path.join(root, f)
+                papers.append(full_path)
+    stats.count("files_found", len(papers))
     return papers
 
 
-def copy_papers_to_tidy_places(paper_paths):
+def load_tidy_index(path=tidy_index_path):
+    # The index remembers the sha1 of every file tidy has looked at, untidy and tidy alike:
+    # {"_User files\untidy papers\May 2014\Computer_science_paper_1__SL.pdf": {"size": .., "mtime": .., "sha1": ..}}
+    # so a file is only read again when its size or mtime changes, and re-running over a big archive is quick.
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+def save_tidy_index(index, path=tidy_index_path):
+    save_json(index, path)
+
+
+def reflink(source, destination):
+    # a copy-on-write copy (btrfs, xfs, APFS): instant, and takes no space until one of the files changes.
+    # Only Linux lets python ask for one, everywhere else this just says no.
+    try:
+        import fcntl
+    except ImportError:
+        return False
+    with open(source, "rb") as src, open(destination, "wb") as dst:
+        try:
+            fcntl.ioctl(dst.fileno(), ficlone, src.fileno())
+            return True
+        except OSError:
+            pass
+    os.remove(destination)
+    return False
+
+
+def place_file(source, destination):
+    # puts a copy of source at destination as cheaply as the file system allows:
+    # a hard link, then a reflink, then a real copy. Returns which one it managed.
+    with temporary_path_for(destination) as temporary_path:
+        try:
+            os.link(source, temporary_path)
+            how = "linked"
+        except OSError:
+            if reflink(source, temporary_path):
+                how = "reflinked"
+            else:
+                shutil.copyfile(source, temporary_path)
+                how = "copied"
+    return how
+
+
+def plan_tidy(paper_paths, index, workers=tidy_workers, stats=None):
+    # works out where every untidy file goes, and which tidy files need anything doing at all.
+    # Returns (jobs, up_to_date, duplicates, clashes):
+    #   jobs: [(source, destination, sha1)] for tidy papers that are missing or different
+    #   up_to_date: how many tidy papers are already there and the same
+    #   duplicates: [[path, path, ..]] untidy files that are byte for byte the same
+    #   clashes: [(destination, [path, ..])] different files that would all get the same tidy name
+    stats = stats or Instrumentation()
+
+    # hashing reads every new file once, and hashlib lets go of the GIL, so threads make it quicker.
+    with stats.stage("hash"), ThreadPoolExecutor(max_workers=workers) as executor:
+        source_hashes = dict(zip(paper_paths, executor.map(lambda path: cached_sha1(index, path, path), paper_paths)))
+
+    paths_by_hash = {}
+    for path in paper_paths:
+        paths_by_hash.setdefault(source_hashes[path], []).append(path)
+    duplicates = [paths for paths in paths_by_hash.values() if len(paths) > 1]
+
+    # several untidy files can be tidied to the same name. Like copying them one by one, the last one found wins.
+    sources_by_destination = {}
     for path in paper_paths:
         paper = Paper(path)
+        destination = os.path.join(tidy_path, paper.year, paper.month, paper.name)
+        sources_by_destination.setdefault(destination, []).append(path)
+    clashes = [(destination, sources) for destination, sources in sources_by_destination.items()
+               if len({source_hashes[source] for source in sources}) > 1]
+
+    def up_to_date(destination):
+        source = sources_by_destination[destination][-1]
+        try:
+            if os.path.samefile(source, destination):
+                return True  # already hard linked, so there's nothing to even read
+            if os.path.getsize(source) != os.path.getsize(destination):
+                return False
+        except FileNotFoundError:
+            return False
+        return cached_sha1(index, destination, destination) == source_hashes[source]
+
+    with stats.stage("check"), ThreadPoolExecutor(max_workers=workers) as executor:
+        destinations = list(sources_by_destination)
+        done = list(executor.map(up_to_date, destinations))
+    jobs = []
+    for destination, is_up_to_date in zip(destinations, done):
+        if not is_up_to_date:
+            source = sources_by_destination[destination][-1]
+            jobs.append((source, destination, source_hashes[source]))
+    up_to_date_count = len(destinations) - len(jobs)
+    stats.count("files_up_to_date", up_to_date_count)
+    return jobs, up_to_date_count, duplicates, clashes
+
+
+def copy_papers_to_tidy_places(paper_paths, workers=tidy_workers, stats=None):
+    # only papers that are new or have changed are copied, hard linked where possible, several at once.
+    stats = stats or Instrumentation()
+    started = time.perf_counter()
+    index = load_tidy_index()
+    jobs, up_to_date_count, duplicates, clashes = plan_tidy(paper_paths, index, workers, stats)
+
+    for paths in duplicates:
+        print("Identical files:", ", ".join(paths))
+    for destination, sources in clashes:
+        print(f"Warning: {len(sources)} different files would all be {destination}, using {sources[-1]}")
+
+    # identical papers that end up with different names are only copied once, the rest link to that copy.
+    jobs_by_hash = {}
+    for source, destination, sha1 in jobs:
+        jobs_by_hash.setdefault(sha1, []).append((source, destination))
+
+    def place(same_file_jobs):
+        placed = []
+        first_destination = None
+        for source, destination in same_file_jobs:
+            os.makedirs(os.path.dirname(destination), exist_ok=True)
+            with stats.stage("copy"):
+                how = place_file(first_destination or source, destination)
+            stats.count("files_" + how)
+            if how == "copied":
+                stats.count("bytes_copied", os.path.getsize(destination))
+            first_destination = first_destination or destination
+            placed.append((destination, how))
+        return placed
+
+    placed_counts = {}
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for sha1, placed in zip(jobs_by_hash, executor.map(place, jobs_by_hash.values())):
+            for destination, how in placed:
+                placed_counts[how] = placed_counts.get(how, 0) + 1
+                print(how.capitalize(), "to", destination)
+                # the new tidy file has the same contents, so there's no need to read it next time.
+                stat = os.stat(destination)
+                index[destination] = {"size": stat.st_size, "mtime": stat.st_mtime_ns, "sha1": sha1}
 
-        paper_folder = os.path.join(tidy_path, paper.year, paper.month)
-        os.makedirs(paper_folder, exist_ok=True)
+    save_tidy_index({path: entry for path, entry in index.items() if os.path.isfile(path)})  # forgets deleted files
+    print()
+    print(f"Tidied {len(paper_paths)} files in {time.perf_counter() - started:.2f} seconds: "
+          + "".join(f"{count} {how}, " for how, count in sorted(placed_counts.items()))
+          + f"{up_to_date_count} already up to date, "
+          f"{sum(len(paths) - 1 for paths in duplicates)} duplicates.")
 
-        new_path = os.path.join(paper_folder, paper.name)
-        shutil.copy(path, new_path)
-        print("Copied to", new_path)
 
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Copy downloaded IB papers into the tidy folder structure.")
+    parser.add_argument("--workers", type=int, default=tidy_workers,
+                        help="files hashed and copied at once (default: %(default)s)")
+    parser.add_argument("--instrument", action="store_true",
+                        help="time every stage and write a report to _User files/reports at the end")
+    args = parser.parse_args()
 
-papers = get_all_paper_paths()
-copy_papers_to_tidy_places(papers)
+    run_stats = Instrumentation(args.instrument)
+    papers = get_all_paper_paths(stats=run_stats)
+    copy_papers_to_tidy_places(papers, workers=args.workers, stats=run_stats)
+    run_stats.write_report("tidy papers")
@@ -1,30 +1,64 @@
 from PIL import Image
-import pandas as pd
-from math import sqrt
+from math import sqrt, isnan
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import argparse
+import traceback
+import json
+import time
 import os
 
-from pdf2image import convert_from_path  # library needed to convert pdf to images
+import numpy as np
+from pdf2image import convert_from_path, pdfinfo_from_path  # library needed to convert pdf to images
 from pdf2image.exceptions import PDFPageCountError
 
+from instrumentation import Instrumentation, profile_call
+from file_tools import save_json, cached_sha1, replaced_atomically
+from question_store import load_questions
+
 # the pdf2image library depends on poppler binary being installed.
 poppler_path = r"poppler/Library/bin"  # I have it near the Python file. Change path as appropriate.
 
 user_path = "_User files"
 papers_path = os.path.join(user_path, "papers")  # this is the local folder where tidied papers go
 image_path = os.path.join(user_path, "images")  # this is the local folder where clipped images go for each paper
+manifest_path = os.path.join(image_path, "manifest.json")  # records what every slice was cut from, see load_manifest
 
 A4_h_to_w_ratio = sqrt(2)
 page_header = 72  # pixels - ballpark
 page_footer = 200  # pixels - ballpark
 question_buffer = 30  # pixels - ballpark, looks nice
+trim_slices = False  # cut page headers/footers and spare white out of slices, see PaperPages.trim. Also --trim.
+# Off unless asked for: turning it on re-cuts every slice, and it drops the header and footer bands whatever is in them
+trim_margin = 60  # pixels of white kept above and below a trimmed slice - the export stamp sits in the top 60
+blank_level = 245  # a row with nothing darker than this is blank (anti-aliasing is never quite white)
 
 left_column_margin = 0.12  # proportional boundary from left edge to question body - quite precise
+slicing_workers = 1  # papers sliced at the same time, one process each. Can also be set with --workers.
+render_dpi = 200  # resolution pdf pages are rendered at (pdf2image's default)
+# How slices are rendered and stored. Exam pages are nearly all black text on white, so the smaller ones lose little.
+#   dpi - render resolution. Slice coordinates are proportions of the paper, so any dpi crops the same questions
+#   mode - "RGB" colour, "L" greyscale, "P" a palette of palette_colours colours, "1" black and white only
+#   compress_level - PNG's zlib level, 0 to 9. Higher is smaller and slower to save, the pixels are the same
+storage_profiles = {"full": {"dpi": render_dpi, "mode": "RGB", "compress_level": 6},  # how slices always were
+                    "grey": {"dpi": render_dpi, "mode": "L", "compress_level": 9},
+                    "compact": {"dpi": 150, "mode": "L", "compress_level": 9},
+                    "palette": {"dpi": render_dpi, "mode": "P", "compress_level": 9},
+                    "bilevel": {"dpi": render_dpi, "mode": "1", "compress_level": 9}}
+storage_profile = "full"  # can also be set with --storage-profile
+palette_colours = 16
+# what slices were saved with before these were settings
+legacy_settings = {"mode": "RGB", "compress_level": 6, "trim": False}
+manifest_save_interval = 30  # seconds - how often progress is written to the manifest during a long run
+page_render_seconds = 0.3  # ballpark for rendering one page at render_dpi, it goes up with the square of the dpi
+slice_seconds = 0.05  # ballpark for stitching, trimming and saving one slice once its pages are rendered
+overlap_tolerance = 0.002  # proportion of the paper - markscheme boundaries often overlap the next one by a line or so
 
 
 def load_data_from_csv(data_path="data.csv"):
     # default location of the file is next to this program as "data.csv". You can specify a different path.
-    question_df = pd.read_csv(data_path)
-    return question_df
+    # Comes back as a question_store Table, read from its compact copy unless data.csv has changed.
+    return load_questions(data_path)
 
 
 def hash_paper_address(paper_address):
@@ -33,125 +67,782 @@ def hash_paper_address(paper_address):
     return paper_folder_name
 
 
-def make_monster_png(path_to_file):
+def render_settings(profile=None):
+    # everything about how a slice is rendered and stored, from storage_profiles.
+    # It is stored with each slice in the manifest, so changing any of it re-renders the slices,
+    # and anything using a slice can tell what it is getting.
+    return dict(storage_profiles[profile or storage_profile], trim=trim_slices)
+
+
+def storage_image(img, settings):
+    # turns a crop into the colour mode its slice is stored in.
+    if settings["mode"] == "1":
+        return img.convert("L").convert("1", dither=Image.Dither.NONE)  # dithering only makes text fuzzy
+    if settings["mode"] == "P":
+        return img.quantize(palette_colours)
+    return img.convert(settings["mode"])
+
+
+def load_manifest(path=manifest_path):
+    # The manifest remembers, for every slice, exactly what it was cut from:
+    # {"pdfs": {"2014\May\Computer_science_paper_1_HL.pdf": {"size": .., "mtime": .., "sha1": ..}},
+    #  "slices": {"2014MayComputer_science_paper_1_HL\8q.png": {"pdf": .., "pdf_sha1": .., "start": .., "end": ..,
+    #                                                              "settings": {..}}}}
+    # so a slice is only cut again when the pdf, its coordinates in data.csv or the render settings change.
     try:
-        # try to load the pdf as a list of page image files.
-        images = convert_from_path(path_to_file, poppler_path=poppler_path)
+        with open(path) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {"pdfs": {}, "slices": {}}
+
+
+def save_manifest(manifest, path=manifest_path):
+    save_json(manifest, path)
+
+
+def pdf_fingerprint(manifest, paper_address):
+    # returns the sha1 of the pdf, or None if there is no such pdf.
+    return cached_sha1(manifest["pdfs"], paper_address, os.path.join(papers_path, paper_address))
+
+
+def validate_boundaries(papers, starts, ends):
+    # checks one pair of boundary columns (questions or markschemes) for every row of data.csv at once.
+    # papers is a number for every row, the same for rows of the same paper, starts and ends are the coordinates.
+    # Returns {problem: array of True/False, one per row}:
+    #   missing - a boundary is blank, inverted - it ends where or before it starts,
+    #   out_of_range - entirely off the paper, which runs from 0 (top) to 1 (bottom),
+    #   overhanging - partly off the paper (plenty of last markschemes end at 1.001). Only a warning, the part
+    #   past the end comes out black like it always has.
+    #   overlapping - starts more than overlap_tolerance before a question above it on the same paper ends.
+    #   Questions with exactly the same region don't count, that's on purpose (see dirty_slices). Also a warning.
+    missing = np.isnan(starts) | np.isnan(ends)
+    with np.errstate(invalid="ignore"):  # NaN compares as False, and missing already has those rows
+        inverted = ~missing & (ends <= starts)
+        out_of_range = ~missing & ~inverted & ((starts >= 1) | (ends <= 0))
+        overhanging = ~missing & ~inverted & ~out_of_range & ((starts < 0) | (ends > 1))
+    overlapping = np.zeros(len(starts), dtype=bool)
+
+    usable = np.flatnonzero(~missing & ~inverted)
+    if len(usable):
+        order = usable[np.lexsort((ends[usable], starts[usable], papers[usable]))]
+        # every paper is moved up past the one before it, so one running maximum over the whole column never
+        # carries the end of one paper's question over into the next paper.
+        offset = papers[order] * (ends[order].max() - starts[order].min() + 1)
+        furthest_end = np.maximum.accumulate(ends[order] + offset)
+        overlaps = np.zeros(len(order), dtype=bool)
+        overlaps[1:] = starts[order][1:] + offset[1:] < furthest_end[:-1] - overlap_tolerance
+        # a question sharing its region with the one before it gets whatever the first of them got.
+        same_region = np.zeros(len(order), dtype=bool)
+        same_region[1:] = ((papers[order][1:] == papers[order][:-1]) & (starts[order][1:] == starts[order][:-1])
+                           & (ends[order][1:] == ends[order][:-1]))
+        first_of_region = np.cumsum(~same_region) - 1
+        overlapping[order] = overlaps[~same_region][first_of_region]
+    return {"missing": missing, "inverted": inverted, "out_of_range": out_of_range, "overhanging": overhanging,
+            "overlapping": overlapping}
+
+
+def validate_questions(questions):
+    # every row of data.csv checked before anything is rendered, see validate_boundaries.
+    # Returns {"no_paper": .., "q": problems with the question boundaries, "a": problems with the markscheme ones}.
+    papers = questions["paper"]
+    paper_numbers = np.unique(["" if paper is None else paper for paper in papers], return_inverse=True)[1]
+    problems = {"no_paper": np.array([paper is None for paper in papers], dtype=bool)}
+    for kind, start, end in [("q", "scrollLocation", "scrollLocation_end"),
+                             ("a", "scrollLocationMS", "scrollLocationMS_end")]:
+        problems[kind] = validate_boundaries(paper_numbers, np.asarray(questions[start]), np.asarray(questions[end]))
+    return problems
+
+
+def unsliceable_rows(problems, kind):
+    # rows whose boundaries can't be cut at all. Overhanging and overlapping ones can.
+    kind_problems = problems[kind]
+    return kind_problems["missing"] | kind_problems["inverted"] | kind_problems["out_of_range"]
+
+
+def print_validation(problems, examples=5):
+    # one line per kind of problem, with the data.csv line numbers of the first few rows that have it.
+    def describe(what, rows):
+        lines = np.flatnonzero(rows) + 2  # the header is line 1
+        if len(lines):
+            shown = ", ".join(str(line) for line in lines[:examples]) + (", ..." if len(lines) > examples else "")
+            print(f"{len(lines)} {what} (data.csv lines {shown})")
+
+    print()
+    describe("rows with no paper, skipped", problems["no_paper"])
+    for kind, name in [("q", "question"), ("a", "markscheme")]:
+        describe(f"{name} boundaries missing, skipped", problems[kind]["missing"])
+        describe(f"{name} boundaries ending before they start, skipped", problems[kind]["inverted"])
+        describe(f"{name} boundaries outside the paper, skipped", problems[kind]["out_of_range"])
+        describe(f"{name} boundaries running off the paper, still sliced", problems[kind]["overhanging"])
+        describe(f"{name} boundaries overlapping the {name} above, still sliced", problems[kind]["overlapping"])
+
+
+def pages_spanned(images, page_count):
+    # the page numbers (from 1) the slices cover. Coordinates are proportions of every page stacked up,
+    # so which page one falls on only depends on the page count, and the pdf needn't be rendered to know.
+    pages = set()
+    for scroll_start, scroll_end in images.values():
+        first_page = min(max(int(scroll_start * page_count), 0), page_count - 1) + 1
+        last_page = min(max(int(np.ceil(scroll_end * page_count)), 1), page_count)
+        pages.update(range(first_page, last_page + 1))
+    return pages
+
+
+def estimate_seconds(page_count, slice_count, settings):
+    return page_count * page_render_seconds * (settings["dpi"] / render_dpi) ** 2 + slice_count * slice_seconds
+
+
+def print_slicing_plan(plan, workers):
+    # the work a run would do, paper by paper, without doing any of it.
+    print()
+    print(f"{'Paper':<45} {'Slices':>6} {'Links':>6} {'Pages':>11} {'Seconds':>8}")
+    for step in plan:
+        if step["missing_pdfs"]:
+            print(f"{step['paper']:<45} missing {', '.join(step['missing_pdfs'])}")
+        slice_count = len(step["qimages"]) + len(step["aimages"])
+        if not slice_count and not step["aliases"]:
+            continue
+        pages = " + ".join(str(len(pages)) if pages is not None else "?" for pages in step["pages"].values())
+        print(f"{step['paper']:<45} {slice_count:>6} {len(step['aliases']):>6} {pages or '-':>11} "
+              f"{step['seconds']:>8.1f}")
+    seconds = sum(step["seconds"] for step in plan)
+    print(f"{sum(len(step['qimages']) + len(step['aimages']) for step in plan)} slices to cut from "
+          f"{sum(len(pages or ()) for step in plan for pages in step['pages'].values())} pages, "
+          f"{sum(len(step['aliases']) for step in plan)} to link. "
+          f"Roughly {seconds:.0f} seconds of work, {seconds / max(workers, 1):.0f} seconds with {workers} workers.")
 
-        page_width = images[0].size[0]
-        page_height = images[0].size[1]
-        total_height = page_height * len(images)
+
+def same_coordinate(a, b):
+    # data.csv coordinates survive the trip through json exactly, this only forgives float parsing differences.
+    return abs(a - b) < 1e-12
+
+
+def link_slice(canonical_path, alias_path):
+    # makes alias_path the same file as canonical_path, without a second copy on disk.
+    # Returns False if the file system can't hard link (FAT usb sticks, say) - the manifest records the alias instead.
+    try:
+        if os.path.exists(alias_path):
+            os.remove(alias_path)
+        os.link(canonical_path, alias_path)
+        return True
+    except OSError:
+        return False
+
+
+def slice_status(entry, entry_wanted, file_exists):
+    # compares what the manifest says a slice was made from with what it should be made from now.
+    # "hit" - nothing changed, "miss" - never made (or deleted since), "invalidated" - made from something else.
+    if entry is None or not file_exists:
+        return "miss"
+    if entry_wanted["pdf_sha1"] is None:
+        # the pdf has gone missing since, so keep whatever was cut from it before.
+        return "hit"
+    if (entry["pdf_sha1"] != entry_wanted["pdf_sha1"]
+            or {**legacy_settings, **entry["settings"]} != entry_wanted["settings"]
+            or not same_coordinate(entry["start"], entry_wanted["start"])
+            or not same_coordinate(entry["end"], entry_wanted["end"])):
+        return "invalidated"
+    return "hit"
+
+
+class PaperPages:
+    # Stands in for the old "monster" png: one tall image made of every page of the pdf stacked on top of each other.
+    # The slice coordinates in data.csv are proportions of that monster, so the same coordinate system is kept here,
+    # but pages are only rendered when a slice actually covers them, and dropped again once no later slice needs them.
+    # The crops come out pixel-identical to cropping the monster, without ever holding the whole document in memory,
+    # and are then trimmed (see trim) if the settings say so.
+    # page_count can be passed in if it is already known (slice_from_pdf reads it while planning), to skip pdfinfo.
+    def __init__(self, path_to_file, stats=None, settings=None, page_count=None):
+        self.path = path_to_file
+        self.stats = stats or Instrumentation()  # see instrumentation.py, does nothing unless switched on
+        self.settings = settings or render_settings()
+        # pdfinfo is cheap and raises PDFPageCountError for a missing pdf, same as convert_from_path did.
+        self.page_count = page_count
+        if page_count is None:
+            with self.stats.stage("pdfinfo"):
+                self.page_count = pdfinfo_from_path(path_to_file, poppler_path=poppler_path)["Pages"]
+        self.pages = {}  # page number (from 1, like poppler) -> rendered page image
+
+        # the monster assumed every page is the size of the first one, so the first page sets the geometry.
+        first_page = self.get_pages(1, 1)[0]
+        self.page_width = first_page.size[0]
+        self.page_height = first_page.size[1]
+        self.page_mode = first_page.mode  # "L" for the black and white modes, which are rendered in greyscale
+        self.total_height = self.page_height * self.page_count
+
+    def render_pages(self, first_page, last_page):
+        with self.stats.stage("render"):
+            images = convert_from_path(self.path, poppler_path=poppler_path, first_page=first_page,
+                                       last_page=last_page, dpi=self.settings["dpi"],
+                                       grayscale=self.settings["mode"] in ("L", "1"))
+        self.stats.count("pages_rendered", len(images))
+        for i, image in enumerate(images):
+            self.pages[first_page + i] = image
+
+    def get_pages(self, first_page, last_page):
+        missing = [n for n in range(first_page, last_page + 1) if n not in self.pages]
+        if missing:
+            # one poppler call for the whole missing run rather than one per page.
+            self.render_pages(missing[0], missing[-1])
+        return [self.pages[n] for n in range(first_page, last_page + 1)]
+
+    def release_pages_before(self, page_number):
+        for n in list(self.pages):
+            if n < page_number:
+                del self.pages[n]
+
+    def pixel_box(self, pixel_start, pixel_end):
+        # rounds exactly like Image.crop does, and fails the same way on missing (NaN) or inverted boundaries.
+        top = round(pixel_start)
+        bottom = round(pixel_end + 1)
+        if bottom < top:
+            raise ValueError("Coordinate 'lower' is less than 'upper'")
+        return top, bottom
+
+    def page_range(self, top, bottom):
+        # maps monster pixel rows to the (first, last) pages they fall on, clamped to pages that exist.
+        first_page = min(max(top // self.page_height, 0), self.page_count - 1) + 1
+        last_page = min(max((bottom - 1) // self.page_height, 0), self.page_count - 1) + 1
+        return first_page, last_page
+
+    def crop(self, pixel_start, pixel_end):
+        # slices are expected to be cropped top to bottom, so anything above this one is no longer needed.
+        top, bottom = self.pixel_box(pixel_start, pixel_end)
+        first_page, last_page = self.page_range(top, bottom)
+        self.release_pages_before(first_page)
+
+        # anything not covered by a page stays black, just like cropping past the end of the monster did.
+        pages = self.get_pages(first_page, last_page)
+        with self.stats.stage("stitch"):
+            img = Image.new(self.page_mode, (self.page_width, bottom - top))
+            for n, page in zip(range(first_page, last_page + 1), pages):
+                img.paste(page, (0, (n - 1) * self.page_height - top))
+        if self.settings.get("trim"):
+            img = self.trim(img, top)
+        return img
+
+    def trim(self, img, top):
+        # Cuts out what a slice doesn't need, a whole row at a time:
+        #   the header and footer zones (page_header, page_footer) of every page the slice covers,
+        #   blank bands inside the slice, shortened to question_buffer rows,
+        #   and blank rows above and below the question, down to trim_margin.
+        # It all works on one projection of the image (the darkest pixel in every row) with numpy, never pixel by
+        # pixel. Only rows go, never columns: every slice keeps the full page width, so the left column that the
+        # question numbers and the export stamp sit in stays in the same place, and exports scale every slice alike.
+        with self.stats.stage("trim"):
+            pixels = np.asarray(img)
+            darkest = pixels.min(axis=tuple(range(1, pixels.ndim)))
+            rows = np.arange(len(darkest))
+
+            # the margins are in pixels at render_dpi, so scale them to whatever this was rendered at.
+            scale = self.settings["dpi"] / render_dpi
+            monster_rows = top + rows
+            page_rows = monster_rows % self.page_height
+            in_zone = ((monster_rows >= 0) & (monster_rows < self.total_height)
+                       & ((page_rows < page_header * scale) | (page_rows >= self.page_height - page_footer * scale)))
+            kept = rows[~in_zone]
+
+            blank = darkest[kept] >= blank_level
+            content = np.flatnonzero(~blank)
+            if len(content) == 0:
+                return img  # nothing but white and headers - leave it be rather than make an empty image
+            first, last = content[0], content[-1]
+            position = np.arange(len(kept))
+            # for every blank row, how far it is into its run of blank rows.
+            run_start = np.maximum.accumulate(np.where(blank, 0, position + 1))
+            inside = (position > first) & (position < last)
+            drop = (blank & inside & (position - run_start >= question_buffer * scale)
+                    | (position < first - trim_margin) | (position > last + trim_margin))
+            kept = kept[~drop]
+            if len(kept) == len(rows):
+                return img
+            return Image.fromarray(pixels[kept])
+
+
+def open_paper_pages(path_to_file, report, settings, page_count=None):
+    try:
+        return PaperPages(path_to_file, report["stats"], settings, page_count)
     except PDFPageCountError:
-        print()
-        print(path_to_file, "doesn't exist")
+        report["log"].append("")
+        report["log"].append(f"{path_to_file} doesn't exist")
         return None
 
-    monster = Image.new("RGB", (page_width, total_height))
-    for i, image in enumerate(images):
-        monster.paste(image, (0, i * page_height))
-    return monster
-
-
-def slice_from_pdf(q_df):  # takes in dataframe of questions.
-    def slice_images(qimages, paper_address):
-        # qimages looks like {"images\2014MayComputer_science_paper_1_HL\8q.png" : (scroll start as float,scroll end)}
-        # paper address looks like "2014\May\Computer_science_paper_1_HL.pdf"
-
-        # if the paper has been processed previously, we should skip opening the pdf and converting to png.
-        # so we check if corresponding sliced pngs already exist for this entire paper and only skip if they all exist.
-        # so if one slice is missing, it would re-do this paper.
-        found_all = True
-        for q in qimages:
-            if not os.path.isfile(q):
-                found_all = False
-        if found_all:
-            print(f"All images for {paper_address} already exist")
-            print()
-            return None
-
-
-        relative_paper_address = os.path.join(papers_path, paper_address)
-        image = make_monster_png(relative_paper_address)  # this loads the pdf and returns it as a long png.
-        # The above always happens, even if the sliced questions already exist.
-        # This means adding a single paper involves processing all of the previous ones again...
-        # Should really rearrange this so that it checks for existing images first...but probably later.
-        if image is None:
-            print("Nothing to slice here.", paper_address)
-            print()
-            return None
-
-        page_width = image.width
-        total_height = image.height
-
-        # NOW DO THE ACTUAL SLICING
-        for question in qimages:
-            # print(qimages)
-            try:
-                scroll_start = qimages[question][0]
-                scroll_end = qimages[question][1]
-
-                pixel_start = scroll_start * total_height
-                pixel_end = scroll_end * total_height
-            except IndexError:
-                # in some cases a question may not have associated start and end coordinates
-                # in this case give some fake data for a blank part of the document.
-                # SHOULD NO LONGER BE THE CASE WITH OCR, but hey...
-                pixel_start = image.height - 10
-                pixel_end = image.height
-            # print(question, pixel_start)
-
-            # page_width = image.width
-            if not os.path.isfile(question):  # if this question slice already exists, skip.
+
+def new_slice_report(paper_address, instrument=False):
+    # everything a slicing job has to say, so it can be printed by whoever collects the job.
+    # "stats" is the job's own Instrumentation, turned into plain numbers (as_dict) when the job is done.
+    # "sizes" has the bytes and seconds of every slice saved, and the bytes of the file it replaced (if any).
+    return {"paper": paper_address, "log": [], "saved": [], "sizes": {}, "missing_boundary": 0, "missing_pdf": 0,
+            "seconds": 0.0, "error": None, "stats": Instrumentation(instrument)}
+
+
+def slice_images(qimages, paper_address, report, settings, page_count=None):
+    # qimages looks like {"images\2014MayComputer_science_paper_1_HL\8q.png" : (scroll start as float,scroll end)}
+    # paper address looks like "2014\May\Computer_science_paper_1_HL.pdf"
+    # report collects the messages and counts (see new_slice_report) instead of printing straight away.
+    # Only slices that need (re)making are passed in - slice_from_pdf checks the manifest - so an empty qimages
+    # means the pdf does not even have to be opened. page_count is the pdf's, if the plan already knows it.
+    log = report["log"]
+    if not qimages:
+        return None
+
+    relative_paper_address = os.path.join(papers_path, paper_address)
+    # only reads the page count and renders the first page.
+    pages = open_paper_pages(relative_paper_address, report, settings, page_count)
+    if pages is None:
+        report["missing_pdf"] += 1
+        log.append(f"Nothing to slice here. {paper_address}")
+        log.append("")
+        return None
+
+    total_height = pages.total_height
+
+    # work out where every slice sits first, so they can be cut from the top of the document to the bottom.
+    boundaries = {}
+    for question in qimages:
+        try:
+            scroll_start = qimages[question][0]
+            scroll_end = qimages[question][1]
+
+            pixel_start = scroll_start * total_height
+            pixel_end = scroll_end * total_height
+        except IndexError:
+            # in some cases a question may not have associated start and end coordinates
+            # in this case give some fake data for a blank part of the document.
+            # SHOULD NO LONGER BE THE CASE WITH OCR, but hey...
+            pixel_start = total_height - 10
+            pixel_end = total_height
+        boundaries[question] = (pixel_start, pixel_end)
+
+    # NOW DO THE ACTUAL SLICING
+    # top to bottom, so pages above the current slice can be let go of as we go.
+    for question in sorted(boundaries, key=lambda q: (isnan(boundaries[q][0]), boundaries[q][0])):
+        pixel_start, pixel_end = boundaries[question]
+        try:
+            started = time.perf_counter()
+            # render just the pages this question spans and cut it out of them.
+            img = storage_image(pages.crop(pixel_start, pixel_end), settings)
+            replaced_bytes = os.path.getsize(question) if os.path.exists(question) else None
+            # saved as a new file rather than over the old one, which may be hard linked to other slices.
+            with report["stats"].stage("png_encode"), replaced_atomically(question, "wb") as f:
+                img.save(f, "PNG", compress_level=settings["compress_level"])
+            seconds = time.perf_counter() - started
+            report["seconds"] += seconds
+            report["sizes"][question] = {"bytes": os.path.getsize(question), "seconds": seconds,
+                                         "replaced_bytes": replaced_bytes}
+            report["stats"].count("slices_saved")
+            report["stats"].count("bytes_written", report["sizes"][question]["bytes"])
+            report["saved"].append(question)
+            log.append(f"Saved: {question}")
+        except ValueError:
+            # if at least one of the boundaries is not provided, then crop can't happen.
+            # Skip this question then.
+            report["missing_boundary"] += 1
+            log.append(f"Missing a boundary: {[pixel_start, pixel_end]}")
+
+
+def slice_paper(job):
+    # one job is a paper and its markscheme, see slice_from_pdf.
+    # This is what runs inside a worker process, so it must never raise: a broken pdf only fails its own job.
+    paper, qimages, markscheme, aimages, instrument, settings, page_counts = job
+    report = new_slice_report(paper, instrument)
+    started = time.perf_counter()
+    try:
+        slice_images(qimages, paper, report, settings, page_counts.get(paper))
+        slice_images(aimages, markscheme, report, settings, page_counts.get(markscheme))
+    except Exception:
+        report["error"] = traceback.format_exc()
+    report["stats"].add_time("paper", time.perf_counter() - started)
+    report["stats"] = report["stats"].as_dict()
+    return report
+
+
+def run_in_processes(function, jobs, workers):
+    # yields (job, function(job), None) for every job, in job order, running them on a pool of worker processes.
+    # A worker that dies (poppler can take it down with it) breaks the whole pool, and every job not done yet fails
+    # with it. So the jobs that could have been running then are tried again one at a time, each in its own pool:
+    # only the one that really crashes comes back as (job, None, the error). The rest carry on in a new pool.
+    pending = list(jobs)
+    while pending:
+        broken_at = None
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(function, job) for job in pending]
+            for position, (job, future) in enumerate(zip(pending, futures)):
                 try:
-                    # crop the full pdf image according to the boundaries provided in the data.
-                    img = image.crop((0, pixel_start, page_width, pixel_end + 1))
-                    img.save(question, "PNG")
-                    print("Saved:", question)
-                except ValueError:
-                    # if at least one of the boundaries is not provided, then crop can't happen.
-                    # Skip this question then.
-                    print("Missing a boundary:", [pixel_start, pixel_end])
+                    result = future.result()
+                except BrokenProcessPool:
+                    broken_at = position
+                    break
+                except Exception:
+                    yield job, None, traceback.format_exc()
+                    continue
+                yield job, result, None
+        if broken_at is None:
+            return
+        # the pool hands out jobs in order, at most one more than it has workers, so usually one of these crashed.
+        # If not, the one that did breaks the next pool too and is found then.
+        suspects = pending[broken_at:broken_at + workers + 1]
+        for job in suspects:
+            with ProcessPoolExecutor(max_workers=1) as executor:
+                try:
+                    yield job, executor.submit(function, job).result(), None
+                except Exception:
+                    yield job, None, traceback.format_exc()
+        pending = pending[broken_at + workers + 1:]
+
+
+def settings_name(settings):
+    # "compact (150 dpi, L, level 9, trimmed)", or just the numbers if they aren't one of storage_profiles.
+    numbers = f"{settings['dpi']} dpi, {settings['mode']}, level {settings['compress_level']}"
+    if settings["trim"]:
+        numbers += ", trimmed"
+    for name, profile in storage_profiles.items():
+        if all(settings[key] == value for key, value in profile.items()):
+            return f"{name} ({numbers})"
+    return numbers
+
+
+def print_storage_report(manifest, settings, replaced):
+    # how much room the slices take and how long they took to cut, for each setting they were made with,
+    # so storage profiles can be compared. Linked slices are only counted once.
+    # Sizes come from the manifest, only slices from before it recorded them are looked at on disk.
+    rows = {}  # settings name -> {"slices", "bytes", "timed", "seconds"}
+    seen_files = set()
+    for key, entry in manifest["slices"].items():
+        if "alias_of" in entry or "linked_to" in entry:
+            continue
+        if "bytes" in entry:
+            size = entry["bytes"]
+        else:
+            try:
+                stat = os.stat(os.path.join(image_path, key))
+            except FileNotFoundError:
+                continue
+            if (stat.st_dev, stat.st_ino) in seen_files:
+                continue  # hard linked before links were recorded
+            seen_files.add((stat.st_dev, stat.st_ino))
+            size = stat.st_size
+        row = rows.setdefault(settings_name({**legacy_settings, **entry["settings"]}),
+                              {"slices": 0, "bytes": 0, "timed": 0, "seconds": 0.0})
+        row["slices"] += 1
+        row["bytes"] += size
+        if "seconds" in entry:  # slices from before sizes were recorded don't have a time
+            row["timed"] += 1
+            row["seconds"] += entry["seconds"]
+
+    print()
+    print(f"Storage profile: {settings_name(settings)}")
+    print(f"{'Slices made with':<40} {'Slices':>7} {'MB':>9} {'KB each':>8} {'s each':>7}")
+    for name, row in sorted(rows.items()):
+        seconds_each = f"{row['seconds'] / row['timed']:.2f}" if row["timed"] else "-"
+        print(f"{name:<40} {row['slices']:>7} {row['bytes'] / 1024 / 1024:>9.1f} "
+              f"{row['bytes'] / 1024 / row['slices']:>8.0f} {seconds_each:>7}")
+    if replaced["slices"]:
+        line = (f"This run re-made {replaced['slices']} slices: {replaced['old_bytes'] / 1024 / 1024:.1f} MB before, "
+                f"{replaced['new_bytes'] / 1024 / 1024:.1f} MB now "
+                f"({100 * replaced['new_bytes'] / max(replaced['old_bytes'], 1):.0f}%)")
+        if replaced["timed"]:
+            line += (f", {replaced['old_seconds'] / replaced['timed']:.2f} s each before, "
+                     f"{replaced['new_seconds'] / replaced['timed']:.2f} s now")
+        print(line + ".")
+
+
+def print_slice_report(report):
+    for line in report["log"]:
+        print(line)
+    if report["error"] is not None:
+        print("Failed while slicing", report["paper"])
+        print(report["error"])
+
+
+def slice_from_pdf(questions, workers=1, stats=None, dry_run=False):  # takes the Table from load_data_from_csv.
+    # workers is the number of papers sliced at the same time, each in its own process. 1 does it all in this one.
+    # stats is an Instrumentation for the run, if it is being measured. The workers' numbers get added to it.
+    # dry_run only prints what is wrong with data.csv and the plan of what would be done, and returns None.
+    stats = stats or Instrumentation()
+    per_paper = []  # render time, slices and bytes for every paper sliced, for the report
 
+    with stats.stage("validate"):
+        problems = validate_questions(questions)
+    print_validation(problems)
+    unsliceable = {kind: unsliceable_rows(problems, kind) for kind in ("q", "a")}
+
+    manifest = load_manifest()
+    settings = render_settings()
+    cache_counts = {"hit": 0, "miss": 0, "invalidated": 0}
+    wanted_entries = {}  # slice path -> manifest entry it will get once it is saved
+    shared = {"slices": 0, "bytes": 0}  # slices linked to an identical region instead of being cut again
+    replaced = {"slices": 0, "old_bytes": 0, "new_bytes": 0, "timed": 0, "old_seconds": 0.0, "new_seconds": 0.0}
+
+    def dirty_slices(images, paper_address, paper_image_path):
+        # keeps only the slices the manifest can't vouch for.
+        # One listdir per paper instead of a stat per image, to notice slices that were deleted by hand.
+        # Several questions often have exactly the same region of a pdf (all of Paper 2's markscheme questions are
+        # the whole markscheme, 0.0 to 1.0). Those are only cut once, and the rest become links to it -
+        # returns (slices to cut, {alias path: path of the identical slice it should link to}).
+        pdf_sha1 = pdf_fingerprint(manifest, paper_address)
+        existing_files = set(os.listdir(paper_image_path)) if os.path.isdir(paper_image_path) else set()
+
+        statuses = {}
+        for path, (scroll_start, scroll_end) in images.items():
+            key = os.path.relpath(path, image_path)
+            entry = manifest["slices"].get(key)
+            wanted_entries[path] = {"pdf": paper_address, "pdf_sha1": pdf_sha1, "start": scroll_start,
+                                    "end": scroll_end, "settings": settings}
+            file_name = os.path.basename(entry["alias_of"] if entry and "alias_of" in entry else path)
+            statuses[path] = slice_status(entry, wanted_entries[path], file_name in existing_files)
+        for path in images:
+            # an alias is only as good as the slice it points at.
+            entry = manifest["slices"].get(os.path.relpath(path, image_path))
+            if statuses[path] == "hit" and entry and "alias_of" in entry:
+                if statuses.get(os.path.join(image_path, entry["alias_of"])) != "hit":
+                    statuses[path] = "invalidated"
+
+        regions = {}  # (start, end) -> slices of exactly that region, in data order
+        for path, (scroll_start, scroll_end) in images.items():
+            cache_counts[statuses[path]] += 1
+            region = path if isnan(scroll_start) or isnan(scroll_end) else (scroll_start, scroll_end)
+            regions.setdefault(region, []).append(path)
+
+        dirty = {}
+        aliases = {}
+        for paths in regions.values():
+            hits = [path for path in paths if statuses[path] == "hit"]
+            if len(hits) == len(paths):
+                continue
+            if hits:
+                # already cut under another question number, so nothing needs rendering at all.
+                entry = manifest["slices"][os.path.relpath(hits[0], image_path)]
+                canonical = os.path.join(image_path, entry["alias_of"]) if "alias_of" in entry else hits[0]
+            else:
+                canonical = paths[0]
+                dirty[canonical] = images[canonical]
+            for path in paths:
+                if path != canonical and statuses[path] != "hit":
+                    aliases[path] = canonical
+        for path in images:
+            if statuses[path] == "hit":
+                del wanted_entries[path]
+        return dirty, aliases
+
+    def link_aliases(aliases, saved):
+        # points every alias at its identical slice, once that exists.
+        for alias, canonical in aliases.items():
+            key = os.path.relpath(alias, image_path)
+            if canonical in wanted_entries and canonical not in saved:
+                # the shared region couldn't be cut this time, so neither could this one.
+                manifest["slices"].pop(key, None)
+                continue
+            entry = dict(wanted_entries[alias])
+            if link_slice(canonical, alias):
+                entry["linked_to"] = os.path.relpath(canonical, image_path)  # so its size isn't counted twice
             else:
-                print("Already exists:", question)
+                entry["alias_of"] = os.path.relpath(canonical, image_path)
+            manifest["slices"][key] = entry
+            shared["slices"] += 1
+            shared["bytes"] += os.path.getsize(canonical)
 
-    q_df.reset_index()  # just in case
-    paper_names = q_df["paper"].unique()
+    # first plan every job, one per paper (with its markscheme), in the order the papers appear in the data.
+    # Nothing is rendered or written while planning, so a dry run can stop once the plan is printed.
+    rows_by_paper = {}
+    for position, paper in enumerate(questions["paper"]):
+        if paper is not None:  # reported by print_validation
+            rows_by_paper.setdefault(paper, []).append(position)
 
-    # loop through papers
-    for paper in paper_names:
+    plan = []
+    unsliceable_count = 0
+    for paper, positions in rows_by_paper.items():
         # paper looks like "2014\May\Computer_science_paper_1_HL.pdf"
-        if pd.isna(paper):
-            continue
         markscheme = paper.replace(".pdf", "_markscheme.pdf")
-        qimages = {}  # question images
-        aimages = {}  # answer images
-
         paper_folder_name = hash_paper_address(paper)  # "2014MayComputer_science_paper_1_HL" e.g.
         paper_image_path = os.path.join(image_path, paper_folder_name)  # images\2014MayComputer_science_paper_1_HL
-        if os.path.exists(paper_image_path) is False:
-            os.mkdir(paper_image_path)
-
-        paper_df = q_df.loc[q_df["paper"] == paper]
-        # print(paper_df)
-        for index, row in paper_df.iterrows():
-            scroll_start = row["scrollLocation"]
-            scroll_end = row["scrollLocation_end"]
-            question_image_path = os.path.join(paper_image_path,
-                                               str(int(row["qNum"]))) + "q.png"  # for questions...
-            # question_image_path looks like "images\2014MayComputer_science_paper_1_HL\8q.png"
-            qimages[question_image_path] = (scroll_start, scroll_end)
-
-            ms_scroll_start = row["scrollLocationMS"]
-            ms_scroll_end = row["scrollLocationMS_end"]
-            markscheme_image_path = os.path.join(paper_image_path,
-                                                 str(int(row["qNum"]))) + "a.png"  # for markschemes.
-            # question_image_path looks like "images\2014MayComputer_science_paper_1_HL\8a.png"
-            aimages[markscheme_image_path] = (ms_scroll_start, ms_scroll_end)
-
-        slice_images(qimages, paper)
-        slice_images(aimages, markscheme)
-
-
-data = load_data_from_csv()
-slice_from_pdf(data)
+        step = {"paper": paper, "markscheme": markscheme, "image_path": paper_image_path, "aliases": {},
+                "pages": {}, "page_counts": {}, "missing_pdfs": [], "seconds": 0.0}
+
+        for pdf, kind, start_column, end_column in [(paper, "q", "scrollLocation", "scrollLocation_end"),
+                                                    (markscheme, "a", "scrollLocationMS", "scrollLocationMS_end")]:
+            images = {}  # e.g. "images\2014MayComputer_science_paper_1_HL\8q.png" -> (start, end)
+            bad = set()
+            for position in positions:
+                image = os.path.join(paper_image_path, str(questions["qNum"][position])) + kind + ".png"
+                images[image] = (questions[start_column][position], questions[end_column][position])
+                # a question can be in data.csv more than once, and like before the last row for it wins.
+                if unsliceable[kind][position]:
+                    bad.add(image)
+                else:
+                    bad.discard(image)
+            for image in bad:
+                # can't be cut, so like a slice that failed it loses its entry instead of trusting an old image.
+                del images[image]
+                manifest["slices"].pop(os.path.relpath(image, image_path), None)
+            unsliceable_count += len(bad)
+
+            with stats.stage("plan"):
+                images, aliases = dirty_slices(images, pdf, paper_image_path)
+            if images and pdf_fingerprint(manifest, pdf) is None:
+                # the pdf isn't there, so there's no point opening it. The slices are tried again next run.
+                # Nor can anything link to them - only links to slices that are already cut are kept.
+                step["missing_pdfs"].append(pdf)
+                aliases = {alias: canonical for alias, canonical in aliases.items() if canonical not in images}
+                images = {}
+            elif images:
+                try:
+                    page_count = pdfinfo_from_path(os.path.join(papers_path, pdf), poppler_path=poppler_path)["Pages"]
+                    step["page_counts"][pdf] = page_count  # passed on to the job, so it needn't ask again
+                    step["pages"][pdf] = pages_spanned(images, page_count)
+                except Exception:
+                    step["pages"][pdf] = None  # a broken pdf - its job will fail and say why
+            step["aliases"].update(aliases)
+            step["qimages" if kind == "q" else "aimages"] = images
+        step["seconds"] = estimate_seconds(sum(len(pages or ()) for pages in step["pages"].values()),
+                                           len(step["qimages"]) + len(step["aimages"]), settings)
+        plan.append(step)
+
+    jobs = [(step["paper"], step["qimages"], step["markscheme"], step["aimages"], stats.enabled, settings,
+             step["page_counts"]) for step in plan if step["qimages"] or step["aimages"]]
+    missing_pdf_count = sum(len(step["missing_pdfs"]) for step in plan)
+    print()
+    print(f"Slice cache: {cache_counts['hit']} up to date, {cache_counts['miss']} missing, "
+          f"{cache_counts['invalidated']} out of date. {len(jobs)} papers to slice.")
+    if dry_run:
+        print_slicing_plan(plan, workers)
+        # nothing else is touched, but the pdf hashes worked out while planning are kept, so the real run
+        # (or the next dry run) doesn't hash every pdf all over again.
+        saved_manifest = load_manifest()
+        saved_manifest["pdfs"] = manifest["pdfs"]
+        save_manifest(saved_manifest)
+        return None
+    print(f"Roughly {sum(step['seconds'] for step in plan) / max(workers, 1):.0f} seconds of work "
+          f"(see --dry-run for the details).")
+    print()
+
+    job_aliases = {}  # paper -> aliases of its slices, linked once the job is done
+    for step in plan:
+        os.makedirs(step["image_path"], exist_ok=True)
+        job_aliases[step["paper"]] = step["aliases"]
+        for pdf in step["missing_pdfs"]:
+            print(f"Nothing to slice here, {os.path.join(papers_path, pdf)} doesn't exist")
+        if not step["qimages"] and not step["aimages"]:
+            # anything left is just links to slices that are already there.
+            link_aliases(step["aliases"], set())
+            if not step["missing_pdfs"]:
+                print(f"All images for {step['paper']} are up to date")
+
+    def collect(job, report):
+        # record what the new slices were made from. Slices that were due but failed lose their entry,
+        # so they are tried again next time instead of trusting an old image.
+        print_slice_report(report)
+        saved = set(report["saved"])
+        for path in list(job[1]) + list(job[3]):
+            key = os.path.relpath(path, image_path)
+            if path in saved:
+                size = report["sizes"][path]
+                if size["replaced_bytes"] is not None:
+                    # for the before and after comparison at the end.
+                    replaced["slices"] += 1
+                    replaced["old_bytes"] += size["replaced_bytes"]
+                    replaced["new_bytes"] += size["bytes"]
+                    old_entry = manifest["slices"].get(key)
+                    if old_entry and "seconds" in old_entry:
+                        replaced["timed"] += 1
+                        replaced["old_seconds"] += old_entry["seconds"]
+                        replaced["new_seconds"] += size["seconds"]
+                manifest["slices"][key] = dict(wanted_entries[path], bytes=size["bytes"], seconds=size["seconds"])
+            else:
+                manifest["slices"].pop(key, None)
+        with stats.stage("link"):
+            link_aliases(job_aliases[job[0]], saved)
+        reports.append(report)
+
+        if report["stats"] is not None:
+            stats.merge(report["stats"])
+            job_stats = report["stats"]
+            per_paper.append({"paper": report["paper"],
+                              "seconds": job_stats["timers"].get("paper", {"seconds": 0.0})["seconds"],
+                              "render_seconds": job_stats["timers"].get("render", {"seconds": 0.0})["seconds"],
+                              "slices": job_stats["counters"].get("slices_saved", 0),
+                              "bytes": job_stats["counters"].get("bytes_written", 0)})
+
+    # then run them. Reports are always printed in job order, however the workers happen to finish.
+    reports = []
+    last_save = time.time()
+    if workers <= 1:
+        for job in jobs:
+            collect(job, slice_paper(job))
+            if time.time() - last_save > manifest_save_interval:
+                with stats.stage("manifest"):
+                    save_manifest(manifest)
+                last_save = time.time()
+    else:
+        for job, report, error in run_in_processes(slice_paper, jobs, workers):
+            if error is not None:
+                # only happens if the worker process itself died (e.g. poppler took it down with it).
+                report = new_slice_report(job[0])
+                report["error"] = error
+                report["stats"] = None
+            collect(job, report)
+            if time.time() - last_save > manifest_save_interval:
+                with stats.stage("manifest"):
+                    save_manifest(manifest)
+                last_save = time.time()
+    with stats.stage("manifest"):
+        save_manifest(manifest)
+
+    failed = [report["paper"] for report in reports if report["error"] is not None]
+    print()
+    print(f"Sliced {len(reports)} papers: {sum(len(r['saved']) for r in reports)} saved, "
+          f"{unsliceable_count + sum(r['missing_boundary'] for r in reports)} missing a boundary, "
+          f"{missing_pdf_count + sum(r['missing_pdf'] for r in reports)} pdfs missing.")
+    print(f"Slice cache: {cache_counts['hit']} hit, {cache_counts['miss']} missed, "
+          f"{cache_counts['invalidated']} invalidated.")
+    if shared["slices"]:
+        # a rough guess at the time saved: the average time it took to cut a slice this run, for every link.
+        saved_count = sum(len(r["saved"]) for r in reports)
+        seconds_per_slice = sum(r["seconds"] for r in reports) / saved_count if saved_count else 0
+        print(f"Shared regions: {shared['slices']} slices linked to an identical slice instead of being cut again, "
+              f"saving {shared['bytes'] / 1024 / 1024:.1f} MB and about {shared['slices'] * seconds_per_slice:.1f} "
+              f"seconds.")
+    if failed:
+        print(f"Failed papers ({len(failed)}), re-run to retry them:")
+        for paper in failed:
+            print(paper)
+    if any(report["saved"] for report in reports):
+        print_storage_report(manifest, settings, replaced)  # nothing to compare if nothing was made
+
+    wall_seconds = time.perf_counter() - stats.started
+    stats.write_report("slice questions", {"slices_per_second": stats.counters.get("slices_saved", 0) / wall_seconds,
+                                           "per_paper": per_paper})
+    return reports
+
+
+if __name__ == "__main__":
+    # the guard matters: worker processes import this file again and must not start slicing themselves.
+    parser = argparse.ArgumentParser(description="Slice question and markscheme images out of the tidied papers.")
+    parser.add_argument("--workers", type=int, default=slicing_workers,
+                        help="papers to slice at the same time, 0 for one per CPU core (default: %(default)s)")
+    parser.add_argument("--storage-profile", choices=list(storage_profiles), default=storage_profile,
+                        help="how slices are rendered and stored, see storage_profiles (default: %(default)s)")
+    parser.add_argument("--trim", action="store_true",
+                        help="cut page headers, footers and spare white out of slices (re-cuts every slice the "
+                             "first time, see PaperPages.trim)")
+    parser.add_argument("--dry-run", action="store_true",
+                        help="check data.csv and print what would be sliced, without rendering or saving anything")
+    parser.add_argument("--instrument", action="store_true",
+                        help="time every stage and write a report to _User files/reports at the end")
+    parser.add_argument("--profile-paper", metavar="PAPER",
+                        help="slice just this paper (as written in data.csv) under cProfile, e.g. "
+                             "\"2014\\May\\Computer_science_paper_1_HL.pdf\"")
+    args = parser.parse_args()
+    storage_profile = args.storage_profile
+    trim_slices = args.trim
+
+    run_stats = Instrumentation(args.instrument)
+    with run_stats.stage("load_csv"):
+        data = load_data_from_csv()
+
+    if args.profile_paper:
+        # one paper, in this process, so the profile sees everything.
+        paper_data = data.where("paper", args.profile_paper)
+        profile_call("slice " + hash_paper_address(args.profile_paper), slice_from_pdf, paper_data, 1, run_stats)
+    else:
+        slice_from_pdf(data, workers=args.workers or os.cpu_count(), stats=run_stats, dry_run=args.dry_run)
@@ -2,35 +2,59 @@ from PIL import Image
 from PIL import ImageDraw
 from PIL import ImageFont
 from math import sqrt
-
-import pandas as pd
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+
+import argparse
+import hashlib
+import html
+import json
+import re
+import shutil
+import threading
+import time
 import os
 
+from instrumentation import Instrumentation
+from question_store import load_questions, load_topics
+from pdf_writer import PdfWriter, Page, a4_points
+from file_tools import replaced_atomically
+from question_hashes import update_hash_index, repeat_groups, hash_workers
+
 user_path = "_User files"
 papers_path = os.path.join(user_path, "papers")  # this is the local folder where tidied papers go
 image_path = os.path.join(user_path, "images")  # this is the local folder where clipped images go for each paper
+manifest_path = os.path.join(image_path, "manifest.json")  # written by "2 slice questions.py"
 export_path = os.path.join(user_path, "collated")  # this is the local folder where exported papers go
+export_cache_path = os.path.join(user_path, "cache")  # finished (stamped, resized) export images, reused across exports
+font_path = os.path.join("font", "monofonto", "monofonto rg.otf")
 
 A4_h_to_w_ratio = sqrt(2)
 page_header = 72  # pixels - ballpark
 page_footer = 200  # pixels - ballpark
 question_buffer = 30  # pixels - ballpark, looks nice
 html_image_width = 900  # pixels
+html_page_size = 50  # questions per HTML page, bigger exports are split into numbered pages
+pdf_page_width = 1654  # pixels - A4 at 200 dpi, what the PDF layout is worked out in
+slice_dpi_before_settings = 200  # the dpi of slices from before the manifest recorded it
+export_workers = os.cpu_count() or 1  # images stamped, resized and encoded at the same time during an export
+jpeg_quality = 75  # Pillow's default
+export_cache_limit = 500 * 1024 * 1024  # bytes - least recently used images are deleted above this
+batch_exports_at_once = 4  # exports worked on at the same time by --batch (they share the export_workers threads)
 
 left_column_margin = 0.12  # proportional boundary from left edge to question body - quite precise
 current_spec_year = 14  # at the time of programming, the current spec first assessment in 2014
 
+stats = Instrumentation()  # stage timers, switched on by --instrument (see instrumentation.py)
+
 
 def load_data_from_csv(data_path="data.csv"):
-    question_df = pd.read_csv(data_path)
-    # print(question_df.iloc[0])
-    return question_df
+    # both come back as question_store Tables, read from their compact copies unless the CSV has changed.
+    return load_questions(data_path)
 
 
 def load_topics_from_csv(topics_path="topics_list.csv"):
-    topics = pd.read_csv(topics_path)
-    topics = topics.fillna("")
-    return topics
+    return load_topics(topics_path)  # blank cells come back as ""
 
 
 def hash_paper_address(paper_address):
@@ -39,14 +63,77 @@ def hash_paper_address(paper_address):
     return paper_folder_name
 
 
-def filter_data(q_df, topics_df, subtopics):
+class QuestionIndex:
+    # Built once when the data is loaded, so that choosing, counting and exporting questions
+    # never has to scan the whole question table again - it is all set unions from here on.
+    def __init__(self, questions, topics):
+        self.questions = questions
+        self.topics = topics
+        self.keys = list(zip(questions["paper"], questions["qNum"]))  # (paper, qNum) for every question
+
+        # link_id -> positions of the questions that have it, in file order
+        self.rows_by_link_id = {}
+        for position, link_id in enumerate(questions["link_id"]):
+            if link_id is None:  # plenty of (mostly Paper 2) questions have no topic at all
+                continue
+            self.rows_by_link_id.setdefault(link_id, []).append(position)
+
+        # subtopic name -> link_ids, and topic number ("3.1") -> link_ids
+        self.link_ids_by_subtopic = {}
+        self.link_ids_by_number = {}
+        for link_id, number, subtopic in zip(topics["link_id"], topics["number"], topics["subtopic"]):
+            self.link_ids_by_subtopic.setdefault(subtopic, set()).add(link_id)
+            self.link_ids_by_number.setdefault(number, set()).add(link_id)
+
+        # distinct (paper, qNum) per link_id, so counts are a union of small sets.
+        self.keys_by_link_id = {link_id: frozenset(self.keys[position] for position in positions)
+                                for link_id, positions in self.rows_by_link_id.items()}
+        self.subtopic_counts = {subtopic: self.count_link_ids(link_ids)
+                                for subtopic, link_ids in self.link_ids_by_subtopic.items()}
+        self.topic_counts = {number: self.count_link_ids(link_ids)
+                             for number, link_ids in self.link_ids_by_number.items()}
+
+    def link_ids(self, subtopics):
+        link_ids = set()
+        for subtopic in subtopics:
+            link_ids.update(self.link_ids_by_subtopic.get(subtopic, ()))
+        return link_ids
+
+    def count_link_ids(self, link_ids):
+        keys = set()
+        for link_id in link_ids:
+            keys.update(self.keys_by_link_id.get(link_id, ()))
+        return len(keys)
+
+    def count(self, subtopics):
+        # number of distinct questions for a selection of subtopics.
+        if len(subtopics) == 1:
+            return self.subtopic_counts.get(subtopics[0], 0)
+        return self.count_link_ids(self.link_ids(subtopics))
+
+    def select(self, subtopics):
+        # positions in questions of the chosen ones, keeping the first row of every (paper, qNum)
+        # in file order - the same rows drop_duplicates used to keep.
+        positions = set()
+        for link_id in self.link_ids(subtopics):
+            positions.update(self.rows_by_link_id.get(link_id, ()))
+
+        chosen = []
+        seen = set()
+        for position in sorted(positions):
+            if self.keys[position] not in seen:
+                seen.add(self.keys[position])
+                chosen.append(position)
+        return chosen
+
+
+def filter_data(index, subtopics):
     # subtopics is a list of subtopic name.
     # this function looks up the matching subtopic ids as "link_id"
-    # and then collates a df of the corresponding questions that have those link_ids.
+    # and then collates a table of the corresponding questions that have those link_ids.
     # ...not sure why I am passing subtopics by name to begin with, if I am honest...
-    link_ids = topics_df[topics_df["subtopic"].isin(subtopics)]["link_id"]
-    chosen_qs = q_df[q_df["link_id"].isin(link_ids)]
-    chosen_qs = chosen_qs.drop_duplicates(subset=["paper", "qNum"], ignore_index=True)
+    # index is the QuestionIndex built at load time, which does the actual looking up.
+    chosen_qs = index.questions.take(index.select(subtopics))
     # print(chosen_qs)
     return chosen_qs
 
@@ -68,12 +155,56 @@ def generate_slice_info(paper_path, qnum, question_or_answer):
     return slice_info
 
 
+@lru_cache(maxsize=None)
+def load_slice_manifest():
+    # what the slicer recorded about every slice, see load_manifest in "2 slice questions.py".
+    # Read once, the first time a slice is looked up.
+    try:
+        with open(manifest_path) as f:
+            return json.load(f)["slices"]
+    except FileNotFoundError:
+        return {}
+
+
+@lru_cache(maxsize=None)
+def load_slice_aliases():
+    # Questions that cover exactly the same region of a pdf share one slice. Usually the slicer hard links them,
+    # but where the file system can't, the manifest says which slice to use instead: {"...\9a.png": "...\8a.png"}
+    return {path: entry["alias_of"] for path, entry in load_slice_manifest().items() if "alias_of" in entry}
+
+
+def slice_dpi(slice_info):
+    # the resolution the slice was cut at, which depends on the storage profile it was made with.
+    entry = load_slice_manifest().get(slice_info["path"], {})
+    return entry.get("settings", {}).get("dpi", slice_dpi_before_settings)
+
+
+def slice_image_path(slice_info):
+    # where the slice's image actually is, following an alias if it has one.
+    return os.path.join(image_path, load_slice_aliases().get(slice_info["path"], slice_info["path"]))
+
+
+fonts = threading.local()
+
+
+def load_font(size):
+    # loading the font file again for every image is slow, so each size is loaded once.
+    # Once per thread, that is - export threads stamp at the same time and a FreeType font is not thread safe.
+    if not hasattr(fonts, "by_size"):
+        fonts.by_size = {}
+    if size not in fonts.by_size:
+        fonts.by_size[size] = ImageFont.truetype(font_path, size)
+    return fonts.by_size[size]
+
+
 def find_and_return_slice_image(slice_info, stamp=True):
     # slice_info is a dict like:
     # {"path": "2014MayComputer_science_paper_1_HL\8a.png", "year_month":"14M", "level_paper":"HL1"}
-    path = os.path.join(image_path, slice_info["path"])
+    path = slice_image_path(slice_info)
     try:
-        img = Image.open(path)
+        with stats.stage("load"):
+            img = Image.open(path)
+            img.load()
     except FileNotFoundError:
         print("No such image", slice_info["path"])
         img = Image.new('RGB', (1500, 100), color=(255, 255, 255))
@@ -81,13 +212,26 @@ def find_and_return_slice_image(slice_info, stamp=True):
         # return img
 
     if stamp:
-        # stamps a year/month/level/paper identifier on each image for reference.
-        # Also adds a rectangle if the question comes from a current specification.
+        img = stamp_image(img, slice_info)
+
+    # img.show()
+    return img
+
+
+def stamp_image(img, slice_info):
+    # stamps a year/month/level/paper identifier on the image for reference.
+    # Also adds a rectangle if the question comes from a current specification.
+    # Slices stored in a compact mode (greyscale, palette or black and white - see storage_profiles in
+    # "2 slice questions.py") are turned back into RGB first, so the stamp keeps its colour.
+    # Returns the stamped image, which is only a new image if it had to be converted.
+    if img.mode != "RGB":
+        img = img.convert("RGB")
+    with stats.stage("stamp"):
         column_width = left_column_margin * img.width
         letter_width = int(column_width / 7)
 
         edited_img = ImageDraw.Draw(img)
-        my_font = ImageFont.truetype(r"font\monofonto\monofonto rg.otf", letter_width)
+        my_font = load_font(letter_width)
         text = slice_info["year_month"] + " " + slice_info["level_paper"]
         if int(slice_info["year_month"][:2]) >= current_spec_year:
             colour = (0, 125, 0)
@@ -96,89 +240,474 @@ def find_and_return_slice_image(slice_info, stamp=True):
         else:
             colour = (100, 100, 100)
         edited_img.text((5, 25), text, colour, font=my_font)
-
-    # img.show()
     return img
 
 
-def export_papers(q_df, topics_df, subtopics):
-    # happens after all of the selection is done.
-    # processes the selected questions and outputs them into an HTML file
-    # the question images are clickable and display the matching markscheme (if it exists)
-    def save_images_for_html(qs, ms, imgpath, scale=True):
-        # qs and ms contain loaded img files, which are kept in memory until saved in the loop below.
-        # Images need to be renamed for HTML use and rescaled/compressed to conserve space.
-        for i, q in enumerate(qs):  # doing questions and answers separately as not all qs have markschemes.
-            savepath = os.path.join(imgpath, str(i + 1) + "q.jpg")
-            if scale:
-                new_width = min(html_image_width, q.width)
-                new_height = int(q.height * new_width / q.width)
-                q = q.resize((new_width, new_height))
-            q.save(savepath, "JPEG")
-
-        for i, a in enumerate(ms):
-            savepath = os.path.join(imgpath, str(i + 1) + "a.jpg")
-            if scale:
-                new_width = min(html_image_width, a.width)
-                new_height = int(a.height * new_width / a.width)
-                a = a.resize((new_width, new_height))  # if no markscheme, this will show a blank image.
-            a.save(savepath, "JPEG")
-
-    def write_html(qs, ms, save_name, save_path, subtopics):
-        html_path = os.path.join(save_path, save_name + ".html")
-        with open(html_path, "w") as site:
-            header = f"<!DOCTYPE html><html><body><h2>{subtopics}</h2>"
-            footer = "</body></html>"
-            middle = ""
-            for i in range(len(qs)):
-                impath = os.path.join("img", str(i + 1) + "q.jpg")  # this needs to be relative to HTML
-                apath = os.path.join("img", str(i + 1) + "a.jpg")  # ... so not using full img_path
-                middle += f"""<div style='font-size: 18px'>{i + 1}.
-                           <a href="{apath}"> 
-                           <img style='height: 100%; 
-                                       width: 80%; 
-
-                                       display: block;
-                                       margin-left: auto;  
-                                       margin-right: auto;
-                                       margin-bottom: 0.6cm' 
-                                       src="{impath}"> </a></div>"""
-            full = header + middle + footer
-            site.write(full)
+def export_cache_key(slice_info, width):
+    # everything that goes into a finished export image. If any of it changes, it is a different image.
+    # Returns None if the slice doesn't exist, as the blank stand-in isn't worth caching.
+    path = slice_image_path(slice_info)
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    key = {"path": slice_info["path"], "size": stat.st_size, "mtime": stat.st_mtime_ns,
+           "stamp": [slice_info["year_month"], slice_info["level_paper"], font_path, left_column_margin],
+           "current_spec_year": current_spec_year, "width": width, "quality": jpeg_quality}
+    return hashlib.sha1(json.dumps(key, sort_keys=True).encode()).hexdigest()
 
-    folder_name = input("Give your exported file a name: ")
 
+def link_or_copy(source, destination):
+    # a hard link costs no space or time. Not every file system allows them, so fall back to copying.
+    try:
+        os.link(source, destination)
+    except OSError:
+        shutil.copyfile(source, destination)
+
+
+def render_export_image(slice_info, savepath, width):
+    # one image from start to finish: load, stamp, rescale, JPEG encode and write.
+    # Nothing is kept afterwards, so an export only ever holds the images currently being worked on.
+    img = find_and_return_slice_image(slice_info)
+    if width is not None:
+        new_width = min(width, img.width)
+        new_height = max(1, int(img.height * new_width / img.width))  # a very wide, short slice can round to 0
+        with stats.stage("resize"):
+            img = img.resize((new_width, new_height))  # if no markscheme, this will show a blank image.
+    with stats.stage("jpeg_encode"):
+        img.save(savepath, "JPEG", quality=jpeg_quality)
+    stats.count("images_made")
+    return img.size
+
+
+cache_locks = {}
+cache_locks_lock = threading.Lock()
+
+
+def cache_key_lock(key):
+    # one lock per cached image, so when several exports want the same image at once,
+    # one of them makes it and the rest wait for it instead of all making it.
+    with cache_locks_lock:
+        return cache_locks.setdefault(key, threading.Lock())
+
+
+def cached_export_image(slice_info, width):
+    # the finished image in export_cache_path, made first if it isn't there yet. Returns (path, size),
+    # or (None, None) if the slice doesn't exist. width None keeps the slice at full size.
+    key = export_cache_key(slice_info, width)
+    if key is None:
+        return None, None
+
+    cached_path = os.path.join(export_cache_path, key[:2], key + ".jpg")
+    with cache_key_lock(key):
+        if os.path.isfile(cached_path):
+            stats.count("cache_hits")
+            os.utime(cached_path)  # marks it as recently used, see trim_export_cache
+            with Image.open(cached_path) as img:  # only reads the header
+                size = img.size
+        else:
+            with replaced_atomically(cached_path, "wb") as f:  # cache_key_lock keeps other threads out
+                size = render_export_image(slice_info, f, width)
+    return cached_path, size
+
+
+def export_slice_image(slice_info, savepath, width=html_image_width):
+    # Finished images are kept in export_cache_path, so a question that has been exported before
+    # is just linked (or copied) out of the cache instead of being stamped, resized and encoded again.
+    cached_path, size = cached_export_image(slice_info, width)
+    if cached_path is None:
+        return render_export_image(slice_info, savepath, width)
+    with stats.stage("link"):
+        link_or_copy(cached_path, savepath)
+    return size
+
+
+def trim_export_cache(limit=export_cache_limit):
+    # deletes the least recently used cached images until the cache fits in the limit (bytes).
+    # Exports hard linked to a deleted image keep their own copy, so nothing already exported breaks.
+    cached = []
+    for root, dirs, files in os.walk(export_cache_path):
+        for f in files:
+            path = os.path.join(root, f)
+            stat = os.stat(path)
+            cached.append((stat.st_mtime, stat.st_size, path))
+
+    total = sum(size for mtime, size, path in cached)
+    for mtime, size, path in sorted(cached):
+        if total <= limit:
+            break
+        os.remove(path)
+        total -= size
+
+
+def make_export_folder(folder_name):
+    # returns the new export's folder, or None if there is already an export with that name.
     save_path = os.path.join(export_path, folder_name)
-    img_path = os.path.join(save_path, "img")
     try:
-        os.makedirs(img_path)
+        os.makedirs(save_path)
     except FileExistsError:
-        print("An export called that already exists. I would rather not overwrite it.")
+        print(f"An export called {folder_name} already exists. I would rather not overwrite it.")
         print("Delete it if you want to save under the same name again.")
         return None
+    return save_path
 
-    chosen_qs = filter_data(q_df, topics_df, subtopics)
-    chosen_qs = chosen_qs.sort_values(["question_type"], ascending=[False])
-    chosen_qs = chosen_qs.reset_index()
 
-    # the two lists below will store references to actual loaded image files.
-    qs = []
-    ms = []
-    for index, row in chosen_qs.iterrows():
-        qslice_info = generate_slice_info(row["paper"], row["qNum"], "q")
-        qs.append(find_and_return_slice_image(qslice_info))
+load_slice_hashes_lock = threading.Lock()
 
-        # the bit below will need reviewing.
-        # If there is no matching mark scheme, it will generate a path to a nonexistent image.
-        # However, if it can't find an image, it will return a small rectangular black image as a placeholder.
-        aslice_info = generate_slice_info(row["paper"], row["qNum"], "a")
-        ms.append(find_and_return_slice_image(aslice_info))
 
-    save_images_for_html(qs, ms, img_path)
-    write_html(qs, ms, folder_name, save_path, subtopics)
+@lru_cache(maxsize=None)
+def load_slice_hashes():
+    # every slice's perceptual hash, {"2014MayComputer_science_paper_1_HL\8q.png": "3f0c.."}, see question_hashes.py.
+    # The hash index is brought up to date the first time it's needed, which only hashes new or changed slices.
+    # Call it from the main thread before any export threads start: hashing runs on a pool of processes, which
+    # shouldn't be started from a thread. If a thread gets here first anyway, it hashes in this process instead.
+    workers = hash_workers if threading.current_thread() is threading.main_thread() else 1
+    with load_slice_hashes_lock, stats.stage("hash_slices"):
+        hash_index, hashed = update_hash_index(image_path, workers)
+    if hashed:
+        print(f"Hashed {hashed} new or changed slices to look for repeated questions.")
+    return {path: entry.get("hash") for path, entry in hash_index["slices"].items()}
 
 
-def topics_selection(q_df, topics_df, selection=list()):
+def paper_session(paper_path):
+    # (year, month) of a paper, e.g. (2014, 5) for "2014\May\Computer_science_paper_1_HL.pdf", newer sorts higher.
+    paper_name = hash_paper_address(paper_path)
+    return int(paper_name[:4]), 11 if paper_name[4:7] == "Nov" else 5
+
+
+def collapse_repeats(chosen_qs):
+    # IB sets some questions again in a later session, or on both the SL and HL paper. This leaves out every
+    # question whose image is a near-duplicate of another chosen one, keeping the one from the newest paper.
+    # Returns a table of the rest, in the same order.
+    hashes = load_slice_hashes()
+    aliases = load_slice_aliases()
+    slice_hashes = []
+    for paper, qnum in zip(chosen_qs["paper"], chosen_qs["qNum"]):
+        path = generate_slice_info(paper, qnum, "q")["path"]
+        slice_hashes.append(hashes.get(aliases.get(path, path)))
+    groups = repeat_groups(slice_hashes)
+
+    newest = {}  # group -> position of the question kept for it
+    for position, (group, paper) in enumerate(zip(groups, chosen_qs["paper"])):
+        if group is None:
+            continue
+        kept = newest.get(group)
+        if kept is None or paper_session(paper) > paper_session(chosen_qs["paper"][kept]):
+            newest[group] = position
+    kept_positions = [position for position, group in enumerate(groups) if group is None or newest[group] == position]
+    if len(kept_positions) < len(chosen_qs):
+        print(f"Left out {len(chosen_qs) - len(kept_positions)} repeated questions, keeping the newest of each.")
+    return chosen_qs.take(kept_positions)
+
+
+def chosen_questions(index, subtopics, collapse=False):
+    # collapse leaves out near-duplicate questions, see collapse_repeats.
+    chosen_qs = filter_data(index, subtopics)
+    if collapse:
+        chosen_qs = collapse_repeats(chosen_qs)
+    return chosen_qs.sort_by("question_type", reverse=True)  # short questions first
+
+
+def export_summary(folder_name, save_path, question_count, started):
+    export_size = 0
+    for root, dirs, files in os.walk(save_path):
+        for f in files:
+            export_size += os.path.getsize(os.path.join(root, f))
+    return {"name": folder_name, "questions": question_count, "seconds": time.perf_counter() - started,
+            "bytes": export_size}
+
+
+def export_papers(index, subtopics, folder_name=None, executor=None, trim_cache=True, page_size=html_page_size,
+                  collapse=False):
+    # happens after all of the selection is done.
+    # processes the selected questions and outputs them into an HTML file (several, if there are over page_size)
+    # the question images are clickable and display the matching markscheme (if it exists)
+    # folder_name is asked for if not given. executor is a thread pool to do the images on, shared by a batch
+    # of exports - otherwise the export makes its own. collapse leaves out repeated questions, see collapse_repeats.
+    # Returns a summary of the export, or None if it didn't happen.
+    def save_images_for_html(chosen_qs, imgpath, scale=True):
+        # Images need to be renamed for HTML use and rescaled/compressed to conserve space.
+        # They are streamed through export_slice_image on a thread pool (Pillow lets go of the GIL while
+        # resizing and encoding), so at most export_workers images are in memory at any time.
+        jobs = []
+        for i, (paper, qnum) in enumerate(zip(chosen_qs["paper"], chosen_qs["qNum"])):
+            jobs.append((generate_slice_info(paper, qnum, "q"), os.path.join(imgpath, str(i + 1) + "q.jpg")))
+
+            # the bit below will need reviewing.
+            # If there is no matching mark scheme, it will generate a path to a nonexistent image.
+            # However, if it can't find an image, it will return a blank rectangular image as a placeholder.
+            jobs.append((generate_slice_info(paper, qnum, "a"), os.path.join(imgpath, str(i + 1) + "a.jpg")))
+
+        width = html_image_width if scale else None
+        if executor is None:
+            with ThreadPoolExecutor(max_workers=export_workers) as own_executor:
+                sizes = list(own_executor.map(lambda job: export_slice_image(job[0], job[1], width), jobs))
+        else:
+            sizes = list(executor.map(lambda job: export_slice_image(job[0], job[1], width), jobs))
+        return sizes[0::2]  # the sizes of the question images, in order
+
+    def html_page_name(save_name, page_number):
+        # the first page keeps the plain name, so a small export is still a single "name.html".
+        return f"{save_name}.html" if page_number == 1 else f"{save_name}_{page_number}.html"
+
+    def write_html(question_sizes, save_name, save_path, subtopics):
+        # Big exports are split into pages of page_size questions with links between them,
+        # and every page is written to disk as it goes rather than built up in memory first.
+        # Images are lazy loaded (the browser only fetches them when scrolled near), and have their
+        # width and height set so the page doesn't jump about while they arrive.
+        page_count = max(1, -(-len(question_sizes) // page_size))
+        title = html.escape(str(subtopics))
+
+        def navigation(site, page_number):
+            if page_count == 1:
+                return
+            site.write("<p style='font-size: 18px'>Page: ")
+            for n in range(1, page_count + 1):
+                if n == page_number:
+                    site.write(f"<b>{n}</b> ")
+                else:
+                    site.write(f"<a href=\"{html_page_name(save_name, n)}\">{n}</a> ")
+            site.write("</p>")
+
+        for page_number in range(1, page_count + 1):
+            html_path = os.path.join(save_path, html_page_name(save_name, page_number))
+            with open(html_path, "w") as site:
+                site.write(f"<!DOCTYPE html><html><body><h2>{title}</h2>")
+                navigation(site, page_number)
+                first = (page_number - 1) * page_size
+                for i in range(first, min(first + page_size, len(question_sizes))):
+                    width, height = question_sizes[i]
+                    impath = os.path.join("img", str(i + 1) + "q.jpg")  # this needs to be relative to HTML
+                    apath = os.path.join("img", str(i + 1) + "a.jpg")  # ... so not using full img_path
+                    site.write(f"""<div style='font-size: 18px'>{i + 1}.
+                           <a href="{apath}">
+                           <img style='height: auto;
+                                       width: 80%;
+
+                                       display: block;
+                                       margin-left: auto;
+                                       margin-right: auto;
+                                       margin-bottom: 0.6cm'
+                                       loading="lazy" decoding="async" width="{width}" height="{height}"
+                                       src="{impath}"> </a></div>""")
+                navigation(site, page_number)
+                site.write("</body></html>")
+
+    if folder_name is None:
+        folder_name = input("Give your exported file a name: ")
+
+    started = time.perf_counter()
+    save_path = make_export_folder(folder_name)
+    if save_path is None:
+        return None
+    img_path = os.path.join(save_path, "img")
+    os.makedirs(img_path)
+
+    chosen_qs = chosen_questions(index, subtopics, collapse)
+    question_sizes = save_images_for_html(chosen_qs, img_path)
+    with stats.stage("write_html"):
+        write_html(question_sizes, folder_name, save_path, subtopics)
+    if trim_cache:
+        with stats.stage("trim_cache"):
+            trim_export_cache()
+    return export_summary(folder_name, save_path, len(question_sizes), started)
+
+
+def lay_out_pdf(pdf_path, title, images):
+    # packs images onto A4 pages, top to bottom, leaving page_header and page_footer clear and question_buffer
+    # between them. images is [(question number, (path, size))], in order, size in pixels of the layout below.
+    # Layout is in pixels of a pdf_page_width wide page (so the pixel margins mean what they do on a slice),
+    # and each page is written as soon as it is full, so only one page is in memory at a time.
+    scale = a4_points[0] / pdf_page_width  # points per pixel
+    page_height = round(pdf_page_width * A4_h_to_w_ratio)
+    bottom = page_height - page_footer
+    usable = bottom - page_header
+    page = None
+    page_count = 0
+    y = page_header
+
+    with PdfWriter(pdf_path) as pdf:
+        def new_page():
+            nonlocal page, page_count, y
+            if page is not None:
+                pdf.add_page(page)
+            page = Page()
+            page_count += 1
+            page.text(title, 40 * scale, 50 * scale, 9)
+            page.text(page_count, pdf_page_width / 2 * scale, (page_height - page_footer / 2) * scale, 9)
+            y = page_header
+
+        new_page()
+        for number, (path, size) in images:
+            if path is None:
+                # no slice to show (usually a question with no markscheme), so just say so.
+                if y + 100 > bottom:
+                    new_page()
+                page.text(f"{number}. (no image)", 40 * scale, (y + 60) * scale, 12)
+                y += 100 + question_buffer
+                continue
+
+            image = pdf.add_jpeg(path)  # embedded once, however many times it is used
+            width, height = size
+            if y > page_header and y + min(height, usable) > bottom:
+                new_page()
+            # a slice taller than a page is split: each page shows the next part of it, the rest clipped off.
+            x = (pdf_page_width - width) / 2
+            shown = 0
+            while True:
+                part = min(height - shown, bottom - y)
+                page.image(image, x * scale, (y - shown) * scale, width * scale, height * scale,
+                           clip=(y * scale, part * scale))
+                if shown == 0:
+                    page.text(f"{number}.", (pdf_page_width - 120) * scale, (y + 60) * scale, 12)
+                shown += part
+                if shown >= height:
+                    break
+                new_page()
+            y += part + question_buffer
+        pdf.add_page(page)
+    return page_count
+
+
+def export_pdf(index, subtopics, folder_name=None, executor=None, trim_cache=True, collapse=False):
+    # the same questions as export_papers, as printable A4 pdfs: one of the questions and a companion one
+    # of their markschemes, numbered to match. Images come from the export cache at their own resolution, and are
+    # placed at the size they were on paper, whatever dpi they were cut at.
+    # Returns a summary of the export, or None if it didn't happen.
+    if folder_name is None:
+        folder_name = input("Give your exported file a name: ")
+
+    started = time.perf_counter()
+    save_path = make_export_folder(folder_name)
+    if save_path is None:
+        return None
+
+    def pdf_image(slice_info):
+        # (path, size in layout pixels), or (None, None). A slice is a page wide at its own dpi, so capping it at
+        # that width never shrinks it, and the layout is at 200 dpi, so a 150 dpi slice is drawn 200 / 150 bigger.
+        dpi = slice_dpi(slice_info)
+        path, size = cached_export_image(slice_info, round(pdf_page_width * dpi / slice_dpi_before_settings))
+        if path is None:
+            return None, None
+        scale = slice_dpi_before_settings / dpi
+        return path, (size[0] * scale, size[1] * scale)
+
+    chosen_qs = chosen_questions(index, subtopics, collapse)
+    title = ", ".join(subtopics)
+    for question_or_answer, suffix in [("q", ""), ("a", "_markscheme")]:
+        slices = [generate_slice_info(paper, qnum, question_or_answer)
+                  for paper, qnum in zip(chosen_qs["paper"], chosen_qs["qNum"])]
+        if executor is None:
+            with ThreadPoolExecutor(max_workers=export_workers) as own_executor:
+                images = list(own_executor.map(pdf_image, slices))
+        else:
+            images = list(executor.map(pdf_image, slices))
+        for info, (path, size) in zip(slices, images):
+            if path is None:
+                print("No such image", info["path"])
+
+        with stats.stage("write_pdf"):
+            pdf_path = os.path.join(save_path, folder_name + suffix + ".pdf")
+            lay_out_pdf(pdf_path, title + (" - markschemes" if suffix else ""), enumerate(images, start=1))
+    if trim_cache:
+        with stats.stage("trim_cache"):
+            trim_export_cache()
+    return export_summary(folder_name, save_path, len(chosen_qs), started)
+
+
+def load_batch_spec(spec_path):
+    # a spec file is JSON listing the exports to make, each a folder name and the subtopics to put in it:
+    # {"exports": [{"name": "Networks", "subtopics": ["Network fundamentals", "Data transmission"]}, ...]}
+    # An export can also have its own "page_size", the number of questions per HTML page,
+    # its own "format", "html" or "pdf", and its own "collapse_repeats", true or false.
+    # Raises ValueError for a page_size that isn't a whole number above 0, before anything is exported.
+    with open(spec_path) as f:
+        exports = json.load(f)["exports"]
+    for export in exports:
+        page_size = export.get("page_size", html_page_size)
+        if type(page_size) is not int or page_size < 1:
+            raise ValueError(f"{spec_path}: {export.get('name')} has page_size {page_size!r}, "
+                             f"it should be a whole number above 0")
+    return exports
+
+
+def positive_int(text):
+    # an argparse type, for --page-size.
+    try:
+        number = int(text)
+    except ValueError:
+        number = 0
+    if number < 1:
+        raise argparse.ArgumentTypeError(f"{text!r} should be a whole number above 0")
+    return number
+
+
+def every_subtopic_selections(index):
+    # one export per subtopic in topics_list.csv, e.g. {"name": "3.1 Data transmission", ...}
+    selections = []
+    for number, subtopic in zip(index.topics["number"], index.topics["subtopic"]):
+        name = re.sub(r'[<>:"/\\|?*]', "", f"{number} {subtopic}")  # characters Windows won't have in a folder name
+        selections.append({"name": name, "subtopics": [subtopic]})
+    return selections
+
+
+def batch_export(index, selections, exports_at_once=batch_exports_at_once, page_size=html_page_size,
+                 export_format="html", collapse=False):
+    # makes many exports in one go, without any menus. The data is only loaded once, exports run side by side,
+    # and they share one pool of image threads and the export cache - so an image several exports have in common
+    # is stamped and encoded once and then linked into all of them.
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=export_workers) as image_executor:
+        with ThreadPoolExecutor(max_workers=exports_at_once) as export_executor:
+            futures = []
+            names = set()
+            for selection in selections:
+                if selection["name"] in names:
+                    # the same folder twice in one batch - only the first one is made, so it is always the same one.
+                    print(f"Export {selection['name']} is in the batch more than once, only making the first one.")
+                    futures.append(None)
+                    continue
+                names.add(selection["name"])
+                collapse_selection = selection.get("collapse_repeats", collapse)
+                if selection.get("format", export_format) == "pdf":
+                    futures.append(export_executor.submit(export_pdf, index, selection["subtopics"],
+                                                          selection["name"], image_executor, False,
+                                                          collapse_selection))
+                    continue
+                futures.append(export_executor.submit(export_papers, index, selection["subtopics"],
+                                                      selection["name"], image_executor, False,
+                                                      selection.get("page_size", page_size), collapse_selection))
+
+            summaries = []
+            for selection, future in zip(selections, futures):
+                if future is None:
+                    summaries.append(None)
+                    continue
+                try:
+                    summaries.append(future.result())
+                except Exception as e:
+                    # one bad export (e.g. an unwritable folder name) shouldn't cost the rest of the batch.
+                    print(f"Export {selection['name']} failed: {e!r}")
+                    summaries.append(None)
+    with stats.stage("trim_cache"):
+        trim_export_cache()
+
+    print()
+    print(f"{'Export':<50} {'Questions':>9} {'Seconds':>8} {'MB':>8}")
+    for selection, summary in zip(selections, summaries):
+        if summary is None:
+            print(f"{selection['name']:<50} {'skipped':>9}")
+        else:
+            print(f"{summary['name']:<50} {summary['questions']:>9} {summary['seconds']:>8.2f} "
+                  f"{summary['bytes'] / 1024 / 1024:>8.2f}")
+    done = [summary for summary in summaries if summary is not None]
+    stats.count("exports", len(done))
+    print(f"{len(done)} of {len(selections)} exports made in {time.perf_counter() - started:.2f} seconds, "
+          f"{sum(summary['bytes'] for summary in done) / 1024 / 1024:.2f} MB in total.")
+    return summaries
+
+
+def topics_selection(index, selection=list(), page_size=html_page_size, collapse=False):
     # the main point of interaction.
     # Menu that allows the user to select which topics they would like questions for.
 
@@ -188,7 +717,7 @@ def topics_selection(q_df, topics_df, selection=list()):
         print()
         print("Select topic category by topic code:")
         for i, key in enumerate(sorted(topic_dict)):
-            print(f"{key} {topic_dict[key]}")
+            print(f"{key} {topic_dict[key]} ({index.topic_counts.get(key, 0)} questions)")
 
         choice = input("Enter topic code, e.g. '1.1': ")
         if choice not in topic_dict.keys():
@@ -200,7 +729,7 @@ def topics_selection(q_df, topics_df, selection=list()):
         print()
         print("Select subtopic by number:")
         for i, subtopic in enumerate(subtopic_list):
-            print(f"{i + 1}. {subtopic}")
+            print(f"{i + 1}. {subtopic} ({index.subtopic_counts.get(subtopic, 0)} questions)")
 
         choice = input("Enter subtopic number, e.g. '2': ")
         try:
@@ -215,11 +744,11 @@ def topics_selection(q_df, topics_df, selection=list()):
         # returns one of the "choices" in the list as a string.
         print()
         if len(selection) > 0:
-            numqs = len(filter_data(q_df, topics_df, selection)["link_id"])
+            numqs = index.count(selection)
             print(f"You currently selected {selection}, which is {numqs} questions")
 
         print("Choose to add topics to your selection, or to start the export:")
-        choices = ["Add topics", "Export questions"]
+        choices = ["Add topics", "Export questions", "Export questions as PDF"]
         for i, c in enumerate(choices):
             print(f"{i + 1}. {c}")
         choice = input("Selection: ")
@@ -237,16 +766,17 @@ def topics_selection(q_df, topics_df, selection=list()):
         # ... that then takes the user to select a subtopic from the chosen bigger topic.
         # Appends final subtopic choice to the "selection" list as a string.
         # Returns to outer function.
+        topics = index.topics
         topic_dict = {}
-        numbers = topics_df["number"].unique()  # get list of topic codes.
+        numbers = topics.unique("number")  # get list of topic codes.
 
         for n in numbers:
-            topic_dict[n] = topics_df[topics_df["number"] == n]["topic"].iloc[0]
+            topic_dict[n] = topics.where("number", n)["topic"][0]
             # makes a dictionary like {"3.1":"Networks", "5.1":"Abstract Data Structures",..}
 
         topic_num_choice = get_topic_selection(topic_dict)  # this is now e.g. "3.1"
 
-        subtopics = topics_df[topics_df["number"] == topic_num_choice]["subtopic"].unique()
+        subtopics = topics.where("number", topic_num_choice).unique("subtopic")
         # the above line finds all of the matching subtopics for the "3.1" from above.
 
         subtopic_choice = get_subtopic_selection(subtopics)  # this is now e.g. "Trees and linked lists"
@@ -259,13 +789,50 @@ def topics_selection(q_df, topics_df, selection=list()):
     # "selection" starts as empty list, grows as the selection function is re-run.
     if top_choice == "Add topics":  # if adding more topics, run the selection pathway.
         selection = select_topics(selection)
-        topics_selection(q_df, topics_df, selection)  # recursively run self to give option to add more topics.
+        topics_selection(index, selection, page_size, collapse)  # recursively run self to give option to add more.
+    elif top_choice == "Export questions as PDF":
+        export_pdf(index, selection, collapse=collapse)  # printable A4 pages, plus a second pdf of the markschemes
     else:
-        export_papers(q_df, topics_df, selection)  # if done with adding topics, export HTML
-
-
-# find_and_return_slice_image(generate_slice_info("2014\May\Computer_science_paper_1_HL.pdf", 14, "q"))
-topics_df = load_topics_from_csv()
-questions_df = load_data_from_csv()
-
-topics_selection(questions_df, topics_df)
+        export_papers(index, selection, page_size=page_size, collapse=collapse)  # done adding topics, export HTML
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Pick topics and export the matching questions. "
+                                                 "Without any options this asks what to export.")
+    parser.add_argument("--batch", metavar="SPEC",
+                        help="make every export listed in a JSON spec file, no questions asked")
+    parser.add_argument("--every-subtopic", action="store_true",
+                        help="make one export for every subtopic in topics_list.csv, no questions asked")
+    parser.add_argument("--page-size", type=positive_int, default=html_page_size,
+                        help="questions per HTML page, larger exports are split into pages (default: %(default)s)")
+    parser.add_argument("--pdf", action="store_true",
+                        help="make --batch and --every-subtopic exports as A4 pdfs instead of HTML")
+    parser.add_argument("--collapse-repeats", action="store_true",
+                        help="leave out questions that are near-duplicates of another one in the export, keeping "
+                             "the newest (see question_hashes.py)")
+    parser.add_argument("--instrument", action="store_true",
+                        help="time every stage and write a report to _User files/reports at the end")
+    args = parser.parse_args()
+    stats.enabled = args.instrument
+
+    # find_and_return_slice_image(generate_slice_info("2014\May\Computer_science_paper_1_HL.pdf", 14, "q"))
+    with stats.stage("load_csv"):
+        topics = load_topics_from_csv()
+        questions = load_data_from_csv()
+    with stats.stage("index"):
+        question_index = QuestionIndex(questions, topics)
+
+    if args.batch or args.every_subtopic:
+        try:
+            batch = load_batch_spec(args.batch) if args.batch else []
+        except ValueError as error:
+            parser.error(str(error))
+        if args.every_subtopic:
+            batch += every_subtopic_selections(question_index)
+        if args.collapse_repeats or any(selection.get("collapse_repeats") for selection in batch):
+            load_slice_hashes()  # here, before batch_export starts its threads
+        batch_export(question_index, batch, page_size=args.page_size, export_format="pdf" if args.pdf else "html",
+                     collapse=args.collapse_repeats)
+    else:
+        topics_selection(question_index, page_size=args.page_size, collapse=args.collapse_repeats)
+    stats.write_report("build papers")
@@ -0,0 +1,272 @@
+from PIL import Image
+from PIL import ImageDraw
+from multiprocessing import get_context, get_all_start_methods, set_start_method
+import platform
+import argparse
+import contextlib
+import traceback
+import queue
+import random
+import shutil
+import sys
+import tempfile
+import json
+import time
+import csv
+import os
+
+from instrumentation import peak_rss_bytes
+from file_tools import load_script
+
+# Times the slow parts of the pipeline on made up exam papers, so changes to them can be measured.
+# Everything happens in a scratch folder that looks like the real one ("_User files", data.csv, topics_list.csv),
+# so no real IB papers are needed and nothing touches your own files.
+# Each stage runs in a fresh process, so its peak memory is its own. Results come out as JSON.
+
+repo_path = os.path.dirname(os.path.abspath(__file__))
+font_zip = os.path.join(repo_path, "0 Folder structure and font..zip")
+
+page_size = (595, 842)  # A4 in points - rendered at 200 dpi this is the usual 1654 x 2339 page
+months = ["May", "Nov"]
+paper_kinds = ["paper_1_SL", "paper_1_HL", "paper_2_SL", "paper_2_HL"]
+
+
+def paper_addresses(paper_count):
+    # "2000\May\Computer_science_paper_1_SL.pdf", "2000\May\Computer_science_paper_1_HL.pdf", ...
+    addresses = []
+    for i in range(paper_count):
+        kind = paper_kinds[i % len(paper_kinds)]
+        month = months[i // len(paper_kinds) % len(months)]
+        year = 2000 + i // (len(paper_kinds) * len(months))
+        addresses.append(f"{year}\\{month}\\Computer_science_{kind}.pdf")
+    return addresses
+
+
+def draw_page(rng, label, page_number):
+    # something that looks enough like an exam page: a header, a footer and lines of text with gaps between them.
+    page = Image.new("RGB", page_size, "white")
+    draw = ImageDraw.Draw(page)
+    draw.text((40, 20), f"{label} - header", fill="black")
+    draw.text((40, page_size[1] - 40), f"Turn over - page {page_number}", fill="black")
+    y = 60
+    while y < page_size[1] - 70:
+        if rng.random() < 0.8:
+            draw.text((70, y), " ".join(rng.choice(["binary", "network", "stack", "queue", "node", "array",
+                                                     "explain", "outline", "describe", "[2]", "[4]"])
+                                          for _ in range(rng.randint(4, 12))), fill="black")
+        y += rng.randint(14, 30)
+    return page
+
+
+def write_pdf(path, rng, label, pages):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    images = [draw_page(rng, label, n + 1) for n in range(pages)]
+    images[0].save(path, "PDF", save_all=True, append_images=images[1:], resolution=72)
+
+
+def make_workspace(workspace, paper_count, pages_per_paper, questions_per_page, seed):
+    # builds the scratch folder: papers, markschemes, data.csv and topics_list.csv to match.
+    rng = random.Random(seed)
+    for folder in ["papers", "images", "collated"]:
+        os.makedirs(os.path.join(workspace, "_User files", folder), exist_ok=True)
+
+    # the stamp font, from the repo if it has been unzipped, otherwise straight from the zip.
+    font_folder = os.path.join(repo_path, "font")
+    if os.path.isdir(font_folder):
+        shutil.copytree(font_folder, os.path.join(workspace, "font"), dirs_exist_ok=True)
+    else:
+        import zipfile
+        with zipfile.ZipFile(font_zip) as z:
+            for name in z.namelist():
+                if name.startswith("font/"):
+                    z.extract(name, workspace)
+
+    shutil.copy(os.path.join(repo_path, "topics_list.csv"), os.path.join(workspace, "topics_list.csv"))
+    with open(os.path.join(repo_path, "topics_list.csv"), encoding="utf-8-sig") as f:
+        link_ids = [row["link_id"] for row in csv.DictReader(f)]
+
+    rows = []
+    question_count = max(1, round(pages_per_paper * questions_per_page))
+    for address in paper_addresses(paper_count):
+        paper_path = os.path.join(workspace, "_User files", "papers", address)
+        write_pdf(paper_path, rng, address, pages_per_paper)
+        write_pdf(paper_path.replace(".pdf", "_markscheme.pdf"), rng, address + " markscheme",
+                  max(1, pages_per_paper // 2))
+
+        for q in range(question_count):
+            start = q / question_count
+            end = (q + 1) / question_count
+            if "paper_2" in address:
+                ms_start, ms_end = 0.0, 1.0  # like the real Paper 2s, every question gets the whole markscheme
+            else:
+                ms_start, ms_end = start, end
+            question_type = "long" if "paper_2" in address or q >= question_count * 2 // 3 else "short"
+            # like the real data: some questions have no topic, some have two (so two rows).
+            topics = rng.choice([[""], [rng.choice(link_ids)], [rng.choice(link_ids), rng.choice(link_ids)]])
+            for link_id in topics:
+                rows.append([link_id, address, q + 1, start, end, ms_start, ms_end, question_type])
+
+    with open(os.path.join(workspace, "data.csv"), "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["link_id", "paper", "qNum", "scrollLocation", "scrollLocation_end", "scrollLocationMS",
+                         "scrollLocationMS_end", "question_type"])
+        writer.writerows(rows)
+    return len(rows)
+
+
+def run_stage(stage, workspace, options):
+    # runs in its own process (see measure). Returns the stage's timings plus the process's peak memory.
+    os.chdir(workspace)
+    sys.path.insert(0, repo_path)
+    started = time.perf_counter()
+    slicer = load_script("2 slice questions.py", "slice_questions")
+    builder = load_script("3 build papers.py", "build_papers")
+    import_seconds = time.perf_counter() - started  # a fresh process, so this is everything they import too
+    slicer.poppler_path = options["poppler_path"]
+    result = {}
+
+    with open(os.devnull, "w") as quiet, contextlib.redirect_stdout(quiet):
+        if stage in ("load", "load_again"):
+            # what every launch pays for: importing the scripts and loading the CSVs.
+            # The first load builds the compact question store, the second reads it back.
+            result["import_seconds"] = import_seconds
+            started = time.perf_counter()
+            questions = builder.load_data_from_csv()
+            builder.load_topics_from_csv()
+            result["seconds"] = time.perf_counter() - started
+            result["rows"] = len(questions)
+
+        elif stage == "render":
+            # every page of every question paper, like make_monster_png used to do.
+            started = time.perf_counter()
+            pages_rendered = 0
+            for address in paper_addresses(options["papers"]):
+                pages = slicer.PaperPages(os.path.join(slicer.papers_path, address))
+                pages_rendered += len(pages.get_pages(1, pages.page_count))
+            result["seconds"] = time.perf_counter() - started
+            result["pages"] = pages_rendered
+
+        elif stage in ("slice", "slice_again"):
+            # the second run has nothing to do, which times the manifest checks on their own.
+            questions = slicer.load_data_from_csv()
+            started = time.perf_counter()
+            reports = slicer.slice_from_pdf(questions, workers=options["slice_workers"])
+            result["seconds"] = time.perf_counter() - started
+            result["slices_saved"] = sum(len(report["saved"]) for report in reports)
+
+        elif stage == "filter":
+            questions = builder.load_data_from_csv()
+            topics = builder.load_topics_from_csv()
+            started = time.perf_counter()
+            index = builder.QuestionIndex(questions, topics)
+            result["index_seconds"] = time.perf_counter() - started
+
+            # every subtopic on its own, then growing selections, like someone working through the menu.
+            subtopics = topics.unique("subtopic")
+            started = time.perf_counter()
+            questions = 0
+            for i in range(options["repeats"]):
+                for subtopic in subtopics:
+                    questions += len(builder.filter_data(index, [subtopic]))
+                for n in range(1, len(subtopics) + 1):
+                    index.count(subtopics[:n])
+            result["seconds"] = time.perf_counter() - started
+            result["selections"] = options["repeats"] * len(subtopics) * 2
+            result["questions"] = questions
+
+        elif stage in ("export", "export_again"):
+            # everything in one export. The second export finds all its images in the export cache.
+            questions = builder.load_data_from_csv()
+            topics = builder.load_topics_from_csv()
+            index = builder.QuestionIndex(questions, topics)
+            started = time.perf_counter()
+            summary = builder.export_papers(index, topics.unique("subtopic"), stage)
+            result["seconds"] = time.perf_counter() - started
+            result["questions"] = summary["questions"]
+            result["bytes"] = summary["bytes"]
+
+    result["peak_rss_bytes"] = peak_rss_bytes()
+    return result
+
+
+def run_stage_in_process(results, stage, workspace, options):
+    # what the stage's own process runs: sends back the stage's numbers, or what went wrong.
+    if options["slice_workers"] > 1 and "fork" in get_all_start_methods():
+        # a spawned process spawns its own children too, and those can't import the slicer (it was loaded from
+        # a file with spaces in its name). Forked ones already have it.
+        set_start_method("fork", force=True)
+    try:
+        results.put((run_stage(stage, workspace, options), None))
+    except Exception:
+        results.put((None, traceback.format_exc()))
+
+
+def measure(stage, workspace, options):
+    # a fresh process per stage, so one stage's memory doesn't count towards the next one's peak.
+    # A plain Process rather than a Pool: a Pool's workers are daemonic, and those can't start the slicer's workers.
+    context = get_context("spawn")
+    results = context.Queue()
+    process = context.Process(target=run_stage_in_process, args=(results, stage, workspace, options))
+    process.start()
+    while True:
+        try:
+            result, error = results.get(timeout=1)
+            break
+        except queue.Empty:
+            if not process.is_alive():
+                try:
+                    result, error = results.get(timeout=1)  # it may have sent something just before it ended
+                    break
+                except queue.Empty:
+                    raise RuntimeError(f"The {stage} stage's process died (exit code {process.exitcode})")
+    process.join()
+    if error is not None:
+        raise RuntimeError(f"The {stage} stage failed:\n{error}")
+    return result
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark rendering, slicing, filtering and exporting "
+                                                 "on made up exam papers, and print the results as JSON.")
+    parser.add_argument("--papers", type=int, default=8, help="number of exam papers to make (default: %(default)s)")
+    parser.add_argument("--pages", type=int, default=12, help="pages per paper (default: %(default)s)")
+    parser.add_argument("--questions-per-page", type=float, default=1.5,
+                        help="question density, so questions per paper = pages x this (default: %(default)s)")
+    parser.add_argument("--repeats", type=int, default=20,
+                        help="times to repeat the filter stage (default: %(default)s)")
+    parser.add_argument("--slice-workers", type=int, default=1,
+                        help="worker processes for slicing. More than 1 needs a platform that forks (Linux)")
+    parser.add_argument("--poppler-path", default=None,
+                        help="folder with the poppler binaries, if they aren't on the PATH")
+    parser.add_argument("--seed", type=int, default=0, help="random seed for the made up papers")
+    parser.add_argument("--workspace", help="folder to build the papers in and keep afterwards "
+                                            "(default: a temporary folder that is deleted)")
+    parser.add_argument("--output", help="write the JSON here instead of printing it")
+    args = parser.parse_args()
+
+    workspace = args.workspace or tempfile.mkdtemp(prefix="question bank benchmark ")
+    options = {"papers": args.papers, "repeats": args.repeats, "slice_workers": args.slice_workers,
+               "poppler_path": os.path.abspath(args.poppler_path) if args.poppler_path else None}
+    try:
+        started = time.perf_counter()
+        rows = make_workspace(workspace, args.papers, args.pages, args.questions_per_page, args.seed)
+        results = {"config": {"papers": args.papers, "pages_per_paper": args.pages,
+                              "questions_per_page": args.questions_per_page, "data_rows": rows,
+                              "repeats": args.repeats, "slice_workers": args.slice_workers, "seed": args.seed},
+                   "environment": {"python": platform.python_version(), "platform": platform.platform(),
+                                   "cpu_count": os.cpu_count()},
+                   "setup_seconds": time.perf_counter() - started,
+                   "stages": {}}
+        for stage in ["load", "load_again", "render", "slice", "slice_again", "filter", "export", "export_again"]:
+            print(f"Running {stage}...", file=sys.stderr)
+            results["stages"][stage] = measure(stage, workspace, options)
+    finally:
+        if not args.workspace:
+            shutil.rmtree(workspace, ignore_errors=True)
+
+    report = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(report)
+    else:
+        print(report)
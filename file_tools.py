@@ -0,0 +1,76 @@
+from contextlib import contextmanager
+import importlib.util
+import hashlib
+import json
+import sys
+import os
+
+# Small file helpers shared by the scripts, so each one doesn't carry its own copy.
+
+repo_path = os.path.dirname(os.path.abspath(__file__))
+
+
+@contextmanager
+def temporary_path_for(path):
+    # with temporary_path_for(path) as temporary_path: ... - whatever the block puts at temporary_path takes path's
+    # place once the block has finished, and is deleted if the block fails. Everything the scripts save goes through
+    # here (or replaced_atomically), so a crash halfway through never leaves half a file behind: anything reading
+    # path gets the old file or the new one. The new file is a new file, too, so it never writes through a hard
+    # link into other files that share the old one.
+    folder = os.path.dirname(path)
+    if folder:
+        os.makedirs(folder, exist_ok=True)
+    temporary_path = path + ".tmp"
+    if os.path.exists(temporary_path):
+        os.remove(temporary_path)  # left behind by a run that was killed
+    try:
+        yield temporary_path
+        os.replace(temporary_path, path)
+    except BaseException:
+        if os.path.exists(temporary_path):
+            os.remove(temporary_path)
+        raise
+
+
+@contextmanager
+def replaced_atomically(path, mode="w"):
+    # with replaced_atomically(path, "wb") as f: img.save(f, "PNG") - temporary_path_for, with the file opened.
+    with temporary_path_for(path) as temporary_path, open(temporary_path, mode) as f:
+        yield f
+
+
+def save_json(data, path):
+    # for the indexes and manifests, see replaced_atomically.
+    with replaced_atomically(path) as f:
+        json.dump(data, f)
+
+
+def cached_sha1(index, key, path):
+    # returns the sha1 of the file at path, or None if there is no such file.
+    # Hashing a whole file is slow, so index[key] remembers it with the file's size and mtime, and the hash is only
+    # worked out again when those change.
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+
+    known = index.get(key)
+    if known is not None and known["size"] == stat.st_size and known["mtime"] == stat.st_mtime_ns:
+        return known["sha1"]
+
+    sha1 = hashlib.sha1()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            sha1.update(chunk)
+    index[key] = {"size": stat.st_size, "mtime": stat.st_mtime_ns, "sha1": sha1.hexdigest()}
+    return sha1.hexdigest()
+
+
+def load_script(file_name, module_name):
+    # the numbered scripts have spaces in their names, so they can't just be imported.
+    # They are registered under module_name so their functions can still be pickled for worker processes.
+    spec = importlib.util.spec_from_file_location(module_name, os.path.join(repo_path, file_name))
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[module_name] = module
+    spec.loader.exec_module(module)
+    return module
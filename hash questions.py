@@ -0,0 +1,52 @@
+import argparse
+import time
+import os
+
+from instrumentation import Instrumentation
+from question_hashes import update_hash_index, repeat_groups, image_path, hash_workers, repeat_distance
+
+# Brings the perceptual hash of every slice up to date (see question_hashes.py) and lists the questions that look
+# like repeats of each other. Run it after "2 slice questions.py". "3 build papers.py --collapse-repeats" updates
+# the hashes by itself, so this is mostly for seeing what would be collapsed, or to get the hashing out of the way.
+
+
+def find_repeats(hash_index, distance=repeat_distance):
+    # groups of question slices ("8q.png", not markschemes) that are near-duplicates of each other, leaving out
+    # groups that are all from one paper - those are questions sharing a region, which the slicer already links.
+    paths = sorted(path for path in hash_index["slices"] if path.endswith("q.png"))
+    groups = repeat_groups([hash_index["slices"][path].get("hash") for path in paths], distance)
+    paths_by_group = {}
+    for path, group in zip(paths, groups):
+        if group is not None:
+            paths_by_group.setdefault(group, []).append(path)
+    return [group_paths for group_paths in paths_by_group.values()
+            if len({os.path.dirname(path) for path in group_paths}) > 1]
+
+
+if __name__ == "__main__":
+    # the guard matters: worker processes import this file again and must not start hashing themselves.
+    parser = argparse.ArgumentParser(description="Hash every slice and list the questions that are repeated.")
+    parser.add_argument("--workers", type=int, default=hash_workers,
+                        help="processes hashing at once, 0 for one per CPU core (default: %(default)s)")
+    parser.add_argument("--distance", type=int, default=repeat_distance,
+                        help="how many of the 256 bits two hashes can differ by and still be a repeat "
+                             "(default: %(default)s)")
+    parser.add_argument("--instrument", action="store_true",
+                        help="time every stage and write a report to _User files/reports at the end")
+    args = parser.parse_args()
+
+    run_stats = Instrumentation(args.instrument)
+    started = time.perf_counter()
+    with run_stats.stage("hash"):
+        index, hashed = update_hash_index(image_path, args.workers or os.cpu_count())
+    run_stats.count("slices_hashed", hashed)
+    hash_seconds = time.perf_counter() - started
+    with run_stats.stage("find_repeats"):
+        repeats = find_repeats(index, args.distance)
+
+    for group_paths in repeats:
+        print("Repeated:", ", ".join(group_paths))
+    print()
+    print(f"{len(index['slices'])} slices, {hashed} hashed in {hash_seconds:.2f} seconds, the rest already up to date.")
+    print(f"{len(repeats)} questions appear more than once, in {sum(len(paths) for paths in repeats)} slices.")
+    run_stats.write_report("hash questions", {"repeated_questions": len(repeats)})
@@ -0,0 +1,146 @@
+from contextlib import contextmanager
+from datetime import datetime
+import cProfile
+import pstats
+import threading
+import json
+import time
+import sys
+import os
+
+# Stage timers and counters for the tidy, slice and build scripts, switched on with their --instrument flag.
+# Switched off, every call returns straight away, so the scripts can leave the calls in place.
+# At the end of a run the numbers are written as JSON (for comparing runs) plus a short human summary.
+
+reports_path = os.path.join("_User files", "reports")  # where run reports and profiles go
+
+
+def peak_rss_bytes():
+    # the most memory this process has used so far.
+    try:
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == "darwin" else peak * 1024  # bytes on macOS, kilobytes everywhere else
+    except ImportError:
+        pass
+    try:
+        # Windows has no resource module, so ask for the peak working set instead.
+        import ctypes
+        from ctypes import wintypes
+
+        class ProcessMemoryCounters(ctypes.Structure):
+            _fields_ = [("cb", wintypes.DWORD), ("PageFaultCount", wintypes.DWORD),
+                        ("PeakWorkingSetSize", ctypes.c_size_t), ("WorkingSetSize", ctypes.c_size_t),
+                        ("QuotaPeakPagedPoolUsage", ctypes.c_size_t), ("QuotaPagedPoolUsage", ctypes.c_size_t),
+                        ("QuotaPeakNonPagedPoolUsage", ctypes.c_size_t), ("QuotaNonPagedPoolUsage", ctypes.c_size_t),
+                        ("PagefileUsage", ctypes.c_size_t), ("PeakPagefileUsage", ctypes.c_size_t)]
+
+        counters = ProcessMemoryCounters()
+        counters.cb = ctypes.sizeof(counters)
+        process = ctypes.windll.kernel32.GetCurrentProcess()
+        ctypes.windll.psapi.GetProcessMemoryInfo(process, ctypes.byref(counters), counters.cb)
+        return counters.PeakWorkingSetSize
+    except (ImportError, AttributeError, OSError):
+        return None
+
+
+class Instrumentation:
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.timers = {}  # stage name -> {"seconds": total, "calls": how many times}
+        self.counters = {}  # counter name -> total
+        self.worker_peak_rss_bytes = None  # the biggest peak of any worker process merged in
+        self.started = time.perf_counter()
+        self.started_at = datetime.now()
+        self.lock = threading.Lock()  # the build script times stages from several threads at once
+
+    @contextmanager
+    def stage(self, name):
+        # with stats.stage("render"): ...  adds the time spent inside to the "render" timer.
+        if not self.enabled:
+            yield
+            return
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(name, time.perf_counter() - started)
+
+    def add_time(self, name, seconds, calls=1):
+        if not self.enabled:
+            return
+        with self.lock:
+            timer = self.timers.setdefault(name, {"seconds": 0.0, "calls": 0})
+            timer["seconds"] += seconds
+            timer["calls"] += calls
+
+    def count(self, name, amount=1):
+        if not self.enabled:
+            return
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def as_dict(self):
+        # plain data, so it can come back from a worker process.
+        return {"timers": self.timers, "counters": self.counters, "peak_rss_bytes": peak_rss_bytes()}
+
+    def merge(self, other):
+        # adds in the numbers from another Instrumentation's as_dict(), e.g. one from a worker process.
+        if not self.enabled:
+            return
+        for name, timer in other["timers"].items():
+            self.add_time(name, timer["seconds"], timer["calls"])
+        for name, amount in other["counters"].items():
+            self.count(name, amount)
+        if other["peak_rss_bytes"] is not None:
+            self.worker_peak_rss_bytes = max(self.worker_peak_rss_bytes or 0, other["peak_rss_bytes"])
+
+    def write_report(self, script_name, extra=None, path=reports_path):
+        # writes "<script>-<date time>.json" and a matching .txt summary, and prints the summary.
+        # extra is anything else worth keeping, e.g. per paper numbers. Its plain numbers make it into the summary.
+        if not self.enabled:
+            return None
+        report = {"script": script_name, "started_at": self.started_at.isoformat(timespec="seconds"),
+                  "wall_seconds": time.perf_counter() - self.started, "timers": self.timers,
+                  "counters": self.counters, "peak_rss_bytes": peak_rss_bytes(),
+                  "worker_peak_rss_bytes": self.worker_peak_rss_bytes, **(extra or {})}
+
+        lines = [f"{script_name}: {report['wall_seconds']:.2f} seconds"]
+        for name, timer in sorted(self.timers.items(), key=lambda item: -item[1]["seconds"]):
+            share = 100 * timer["seconds"] / report["wall_seconds"] if report["wall_seconds"] else 0
+            lines.append(f"  {name:<20} {timer['seconds']:>10.2f} s  {share:>6.1f}%  {timer['calls']:>8} calls")
+        for name, amount in sorted(self.counters.items()):
+            lines.append(f"  {name:<20} {amount:>10}")
+        for name, value in (extra or {}).items():
+            if isinstance(value, (int, float)):
+                lines.append(f"  {name:<20} {value:>10.2f}")
+        for name in ["peak_rss_bytes", "worker_peak_rss_bytes"]:
+            if report[name] is not None:
+                lines.append(f"  {name:<20} {report[name] / 1024 / 1024:>10.1f} MB")
+        lines.append("(stages run in parallel threads or processes add up all of their time, so can pass 100%)")
+        summary = "\n".join(lines)
+
+        os.makedirs(path, exist_ok=True)
+        base_name = os.path.join(path, f"{script_name.replace(' ', '_')}-{self.started_at:%Y%m%d-%H%M%S}")
+        with open(base_name + ".json", "w") as f:
+            json.dump(report, f, indent=2)
+        with open(base_name + ".txt", "w") as f:
+            f.write(summary + "\n")
+        print()
+        print(summary)
+        print("Report written to", base_name + ".json")
+        return report
+
+
+def profile_call(name, function, *args, path=reports_path, **kwargs):
+    # runs function under cProfile, saves the profile as "<name>.prof" (open it with snakeviz, or pstats)
+    # and prints the 25 most expensive calls. Returns whatever the function returned.
+    profiler = cProfile.Profile()
+    result = profiler.runcall(function, *args, **kwargs)
+    os.makedirs(path, exist_ok=True)
+    profile_path = os.path.join(path, name + ".prof")
+    profiler.dump_stats(profile_path)
+    print()
+    pstats.Stats(profiler).sort_stats("cumulative").print_stats(25)
+    print("Profile written to", profile_path)
+    return result
@@ -0,0 +1,129 @@
+from contextlib import ExitStack
+from PIL import Image
+import hashlib
+import io
+import zlib
+
+from file_tools import replaced_atomically
+
+# Just enough of the PDF format to put JPEG images and a little text onto pages, written out as it goes.
+# Only the page being laid out is ever held in memory: each image is read from disk, written into the file and let go.
+# An image that is used more than once (byte for byte the same) is embedded once and shared by every page using it.
+
+a4_points = (595.28, 841.89)  # A4 in PDF units (1/72 inch)
+colour_spaces = {"L": b"/DeviceGray", "RGB": b"/DeviceRGB", "CMYK": b"/DeviceCMYK"}
+
+
+def pdf_string(text):
+    # text as a PDF string. ( ) and \ need escaping, and the built in fonts only know Latin-1.
+    text = str(text).encode("latin-1", "replace")
+    return b"(" + text.replace(b"\\", b"\\\\").replace(b"(", b"\\(").replace(b")", b"\\)") + b")"
+
+
+class Page:
+    # the drawing commands for one page. Positions are in points from the top left corner,
+    # which is easier to lay out with - PDF itself counts up from the bottom left.
+    def __init__(self, size=a4_points):
+        self.width, self.height = size
+        self.commands = []
+        self.images = {}  # resource name -> object number, for the images this page uses
+
+    def image(self, image, x, y, width, height, clip=None):
+        # image is what PdfWriter.add_jpeg returned. clip is (y, height): only that band of the page shows
+        # the image, which is how a slice too tall for one page is split over several.
+        name, number = image[0], image[1]
+        self.images[name] = number
+        command = b"q "
+        if clip is not None:
+            clip_y, clip_height = clip
+            command += b"0 %.2f %.2f %.2f re W n " % (self.height - clip_y - clip_height, self.width, clip_height)
+        command += b"%.2f 0 0 %.2f %.2f %.2f cm /%s Do Q" % (width, height, x, self.height - y - height,
+                                                            name.encode())
+        self.commands.append(command)
+
+    def text(self, text, x, y, size=10):
+        # y is the text's baseline.
+        self.commands.append(b"BT /F1 %.1f Tf %.2f %.2f Td %s Tj ET" % (size, x, self.height - y, pdf_string(text)))
+
+
+class PdfWriter:
+    # with PdfWriter(path) as pdf:
+    #     image = pdf.add_jpeg("1q.jpg")
+    #     page = Page()
+    #     page.image(image, 0, 0, 595, 200)
+    #     pdf.add_page(page)
+    def __init__(self, path):
+        self.path = path
+        self.replacing = ExitStack()  # the pdf only takes path's place once it is finished, see replaced_atomically
+        self.file = self.replacing.enter_context(replaced_atomically(path, "wb"))
+        self.offsets = {}  # object number -> where it starts in the file, for the cross reference table
+        self.next_number = 4  # 1 is the catalog and 2 the page tree (both written last), 3 the font
+        self.page_numbers = []
+        self.images = {}  # sha1 of a JPEG -> (resource name, object number, width, height)
+        self.file.write(b"%PDF-1.4\n%\xe2\xe3\xcf\xd3\n")
+        self.write_object(3, b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica /Encoding /WinAnsiEncoding >>")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.replacing.__exit__(exc_type, exc_value, traceback)  # throws the half written pdf away
+
+    def new_number(self):
+        self.next_number += 1
+        return self.next_number - 1
+
+    def write_object(self, number, dictionary, stream=None):
+        self.offsets[number] = self.file.tell()
+        self.file.write(b"%d 0 obj\n" % number + dictionary)
+        if stream is not None:
+            self.file.write(b"\nstream\n" + stream + b"\nendstream")
+        self.file.write(b"\nendobj\n")
+
+    def add_jpeg(self, path):
+        # a JPEG goes into a PDF as it is, no decoding needed. Returns (name, object number, width, height).
+        with open(path, "rb") as f:
+            data = f.read()
+        sha1 = hashlib.sha1(data).hexdigest()
+        if sha1 not in self.images:
+            with Image.open(io.BytesIO(data)) as img:  # only reads the header
+                width, height = img.size
+                mode = img.mode
+            number = self.new_number()
+            dictionary = (b"<< /Type /XObject /Subtype /Image /Width %d /Height %d /ColorSpace %s "
+                          b"/BitsPerComponent 8 /Filter /DCTDecode /Length %d " % (width, height, colour_spaces[mode],
+                                                                                len(data)))
+            if mode == "CMYK":
+                dictionary += b"/Decode [1 0 1 0 1 0 1 0] "  # Pillow writes Adobe style (inverted) CMYK JPEGs
+            self.write_object(number, dictionary + b">>", data)
+            self.images[sha1] = (f"Im{number}", number, width, height)
+        return self.images[sha1]
+
+    def add_page(self, page):
+        # writes the page out straight away, after which it can be forgotten.
+        contents = zlib.compress(b"\n".join(page.commands))
+        contents_number = self.new_number()
+        self.write_object(contents_number, b"<< /Filter /FlateDecode /Length %d >>" % len(contents), contents)
+
+        images = b" ".join(b"/%s %d 0 R" % (name.encode(), number) for name, number in page.images.items())
+        page_number = self.new_number()
+        self.write_object(page_number, b"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 %.2f %.2f] "
+                                       b"/Resources << /Font << /F1 3 0 R >> /XObject << %s >> >> "
+                                       b"/Contents %d 0 R >>" % (page.width, page.height, images, contents_number))
+        self.page_numbers.append(page_number)
+
+    def close(self):
+        kids = b" ".join(b"%d 0 R" % number for number in self.page_numbers)
+        self.write_object(2, b"<< /Type /Pages /Kids [%s] /Count %d >>" % (kids, len(self.page_numbers)))
+        self.write_object(1, b"<< /Type /Catalog /Pages 2 0 R >>")
+
+        xref_offset = self.file.tell()
+        self.file.write(b"xref\n0 %d\n0000000000 65535 f \n" % self.next_number)
+        for number in range(1, self.next_number):
+            self.file.write(b"%010d 00000 n \n" % self.offsets[number])
+        self.file.write(b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (self.next_number,
+                                                                                         xref_offset))
+        self.replacing.close()
@@ -0,0 +1,167 @@
+from concurrent.futures import ProcessPoolExecutor
+from PIL import Image
+import numpy as np
+import json
+import os
+
+from file_tools import save_json
+
+# Perceptual hashes of the slices, for spotting a question IB has set again in a later session or on the other level.
+# A reprinted question is never byte for byte the same slice (different page, different question number, a
+# slightly different crop), but shrunk down to a 16x16 grid of greys it looks nearly the same, so its hash is too.
+# The hash is a difference hash: one bit per cell, set if the cell is darker than the one to its right.
+# Two hashes are compared by counting the bits that differ (the Hamming distance), 0 for the same picture.
+
+image_path = os.path.join("_User files", "images")  # where "2 slice questions.py" puts the slices
+hash_index_path = os.path.join("_User files", "hash_index.json")  # remembers every slice's hash, see load_hash_index
+hash_version = 1  # bump when the hash changes, so every slice gets hashed again
+hash_size = 16  # cells across and down, so hash_size * hash_size bits (256)
+hash_bytes = hash_size * hash_size // 8
+thumbnail_width = 400  # pixels - slices are shrunk to about this first, the grid cells only need the average grey
+left_column_margin = 0.12  # proportional boundary from left edge to question body - the question number is left of it
+blank_level = 245  # a row or column with nothing darker than this is blank
+repeat_distance = 20  # bits out of 256 - this close are the same question
+hash_workers = os.cpu_count() or 1  # processes hashing at once, decoding the PNGs is the slow part
+hash_chunk_size = 64  # slices per job sent to a worker, so the process pool isn't swamped with tiny jobs
+compare_block_size = 1 << 20  # pairs of hashes compared at once in repeat_groups, 32 MB of XORed bytes
+byte_bit_counts = np.unpackbits(np.arange(256, dtype=np.uint8)[:, None], axis=1).sum(axis=1, dtype=np.uint8)
+
+
+def hash_grid(path):
+    # the slice as a (hash_size, hash_size + 1) grid of greys, or None if it can't be read or is all blank.
+    try:
+        with Image.open(path) as img:
+            img.draft("L", (thumbnail_width, thumbnail_width))  # only does anything for JPEGs, but it's free
+            img = img.convert("L")
+            if img.width > thumbnail_width:
+                img = img.reduce(img.width // thumbnail_width)
+    except (OSError, ValueError):
+        return None
+    pixels = np.asarray(img)
+    pixels = pixels[:, int(pixels.shape[1] * left_column_margin):]  # the question number differs between papers
+
+    # cut away the blank border, so the same question with more or less white around it still lines up.
+    ink = pixels < blank_level
+    rows = np.flatnonzero(ink.any(axis=1))
+    columns = np.flatnonzero(ink.any(axis=0))
+    if len(rows) == 0:
+        return None
+    pixels = pixels[rows[0]:rows[-1] + 1, columns[0]:columns[-1] + 1]
+    grid = Image.fromarray(pixels).resize((hash_size + 1, hash_size), Image.BOX)
+    return np.asarray(grid, dtype=np.int16)
+
+
+def hash_slices(paths):
+    # hashes of the slices as hex strings, None for any that couldn't be hashed. Runs in a worker process.
+    grids = [hash_grid(path) for path in paths]
+    found = [grid for grid in grids if grid is not None]
+    if not found:
+        return [None] * len(paths)
+    # every grid has the same shape, so all the comparing and bit packing happens in one go.
+    stack = np.stack(found)
+    bits = stack[:, :, :-1] > stack[:, :, 1:]
+    packed = iter(np.packbits(bits.reshape(len(found), -1), axis=1))
+    return [None if grid is None else next(packed).tobytes().hex() for grid in grids]
+
+
+def load_hash_index(path=hash_index_path):
+    # {"version": .., "hash_size": .., "slices": {"2014MayComputer_science_paper_1_HL\8q.png":
+    #     {"size": .., "mtime": .., "hash": "3f0c.."}}}, paths relative to image_path.
+    # Like the tidy index, a slice is only hashed again when its size or mtime changes.
+    try:
+        with open(path) as f:
+            index = json.load(f)
+        if index.get("version") == hash_version and index.get("hash_size") == hash_size:
+            return index
+    except (FileNotFoundError, ValueError):
+        pass
+    return {"version": hash_version, "hash_size": hash_size, "slices": {}}
+
+
+def save_hash_index(index, path=hash_index_path):
+    save_json(index, path)
+
+
+def update_hash_index(images=image_path, workers=hash_workers, path=hash_index_path):
+    # hashes every slice that is new or has changed since last time, forgets deleted ones, and saves the index.
+    # Returns (index, how many were hashed).
+    index = load_hash_index(path)
+    old_slices = index["slices"]
+    slices = {}
+    to_hash = []
+    for root, dirs, files in os.walk(images):
+        for f in files:
+            if not f.endswith(".png"):
+                continue
+            full_path = os.path.join(root, f)
+            relative_path = os.path.relpath(full_path, images)
+            stat = os.stat(full_path)
+            entry = {"size": stat.st_size, "mtime": stat.st_mtime_ns}
+            known = old_slices.get(relative_path)
+            if known is not None and known["size"] == entry["size"] and known["mtime"] == entry["mtime"]:
+                slices[relative_path] = known
+            else:
+                slices[relative_path] = entry
+                to_hash.append(relative_path)
+
+    chunks = [to_hash[i:i + hash_chunk_size] for i in range(0, len(to_hash), hash_chunk_size)]
+    chunk_paths = [[os.path.join(images, relative_path) for relative_path in chunk] for chunk in chunks]
+    if workers <= 1 or len(chunks) <= 1:
+        results = list(map(hash_slices, chunk_paths))
+    else:
+        with ProcessPoolExecutor(max_workers=min(workers, len(chunks))) as executor:
+            results = list(executor.map(hash_slices, chunk_paths))
+    for chunk, hashes in zip(chunks, results):
+        for relative_path, slice_hash in zip(chunk, hashes):
+            slices[relative_path]["hash"] = slice_hash  # None for a blank or unreadable slice, never a repeat
+
+    index["slices"] = slices
+    if to_hash or len(slices) != len(old_slices):
+        save_hash_index(index, path)
+    return index, len(to_hash)
+
+
+def hamming_distances(hash_array, rows, others):
+    # bits differing between each of hash_array[rows] and each of hash_array[others], as a len(rows) x len(others)
+    # array. A lookup table of the bits set in every byte value saves unpacking the bits.
+    differing = np.bitwise_xor(hash_array[rows, None, :], hash_array[None, others, :])
+    return byte_bit_counts[differing].sum(axis=2, dtype=np.uint16)
+
+
+def repeat_groups(hashes, distance=repeat_distance):
+    # hashes is a list of hex strings (None for no hash). Returns a group number for each, the same number for
+    # hashes within distance bits of each other (and of anything they are close to), None for no hash.
+    # Every pair is compared, a block of rows at a time so memory stays small. That is n squared, but each pair is
+    # a 32 byte XOR and a table lookup, about a second for a few thousand slices. (Looking hashes up by bands was
+    # tried, but slices are mostly white, so most bands are the same few bytes and the buckets were huge.)
+    hashed = [position for position, slice_hash in enumerate(hashes) if slice_hash is not None]
+    groups = [None] * len(hashes)
+    if not hashed:
+        return groups
+    hash_array = np.frombuffer(b"".join(bytes.fromhex(hashes[position]) for position in hashed),
+                               dtype=np.uint8).reshape(len(hashed), hash_bytes)
+
+    pairs = []
+    block = max(1, compare_block_size // len(hashed))
+    for first in range(0, len(hashed), block):
+        rows = np.arange(first, min(first + block, len(hashed)))
+        others = np.arange(first + 1, len(hashed))  # only later rows, so each pair is measured once
+        if not len(others):
+            break
+        close_rows, close_others = np.nonzero(hamming_distances(hash_array, rows, others) <= distance)
+        later = others[close_others] > rows[close_rows]
+        pairs.append(np.stack([rows[close_rows][later], others[close_others][later]], axis=1))
+
+    parent = list(range(len(hashed)))
+
+    def find(row):
+        while parent[row] != row:
+            parent[row] = parent[parent[row]]
+            row = parent[row]
+        return row
+
+    for row, other in np.concatenate(pairs).tolist() if pairs else []:
+        parent[find(row)] = find(other)
+    for row, position in enumerate(hashed):
+        groups[position] = find(row)
+    return groups
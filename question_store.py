@@ -0,0 +1,202 @@
+from array import array
+import json
+import math
+import sys
+import csv
+import os
+
+from file_tools import replaced_atomically
+
+# data.csv and topics_list.csv, kept as compact binary copies that load in a few milliseconds.
+# Reading the CSVs with pandas meant importing pandas on every launch, which took longer than anything the menus do.
+# A copy is rebuilt by itself whenever its CSV changes size or modification time, so edit the CSVs as usual.
+
+store_path = os.path.join("_User files", "question_store")  # where the compact copies go
+store_version = 1  # bump when the file layout changes, so old copies get rebuilt
+
+# column name -> type, in CSV order. Blank numbers become NaN, blank text becomes the record type's blank.
+question_columns = {"link_id": "str", "paper": "str", "qNum": "int", "scrollLocation": "float",
+                    "scrollLocation_end": "float", "scrollLocationMS": "float", "scrollLocationMS_end": "float",
+                    "question_type": "str"}
+topic_columns = {"link_id": "str", "number": "str", "topic": "str", "subtopic": "str"}
+array_types = {"int": "q", "float": "d", "str": "i"}  # text is saved as its position in a list of distinct strings
+
+
+class Record:
+    # one row of a Table. __slots__ keeps thousands of them small and quick to make.
+    __slots__ = ()
+    columns = {}
+    blank = None
+
+    def __init__(self, *values):
+        for name, value in zip(self.__slots__, values):
+            setattr(self, name, value)
+
+    def __repr__(self):
+        return type(self).__name__ + "(" + ", ".join(f"{name}={getattr(self, name)!r}" for name in self.__slots__) + ")"
+
+
+class Question(Record):
+    # a row of data.csv, e.g. question.paper, question.qNum, question.scrollLocation
+    __slots__ = tuple(question_columns)
+    columns = question_columns
+    blank = None  # plenty of (mostly Paper 2) questions have no link_id
+
+
+class Topic(Record):
+    # a row of topics_list.csv
+    __slots__ = tuple(topic_columns)
+    columns = topic_columns
+    blank = ""
+
+
+class Table:
+    # the rows of a CSV, stored a column at a time: numbers in typed arrays, text in lists.
+    # table["paper"] is a whole column, and iterating over a table gives a record per row.
+    def __init__(self, record_type, columns):
+        self.record_type = record_type
+        self.columns = columns  # column name -> array of numbers, or list of strings
+
+    def __len__(self):
+        return len(self.columns[self.record_type.__slots__[0]])
+
+    def __getitem__(self, name):
+        return self.columns[name]
+
+    def __iter__(self):
+        record_type = self.record_type
+        for values in zip(*(self.columns[name] for name in record_type.__slots__)):
+            yield record_type(*values)
+
+    def take(self, positions):
+        # a new table of just these rows, in this order.
+        columns = {}
+        for name, column in self.columns.items():
+            values = [column[position] for position in positions]
+            columns[name] = array(column.typecode, values) if isinstance(column, array) else values
+        return Table(self.record_type, columns)
+
+    def where(self, name, value):
+        return self.take([position for position, v in enumerate(self.columns[name]) if v == value])
+
+    def unique(self, name):
+        # distinct values of a column, in the order they first appear.
+        return list(dict.fromkeys(self.columns[name]))
+
+    def group_by(self, name):
+        # value -> table of the rows with that value, in the order the values first appear.
+        positions = {}
+        for position, value in enumerate(self.columns[name]):
+            positions.setdefault(value, []).append(position)
+        return {value: self.take(rows) for value, rows in positions.items()}
+
+    def sort_by(self, name, reverse=False):
+        # a stable sort, so rows with the same value stay in file order.
+        # Blanks (None text, NaN numbers) can't be compared, so like pandas they go last, either way round.
+        column = self.columns[name]
+        blank = [value is None or value != value for value in column]
+        filled = [position for position in range(len(self)) if not blank[position]]
+        blanks = [position for position in range(len(self)) if blank[position]]
+        return self.take(sorted(filled, key=column.__getitem__, reverse=reverse) + blanks)
+
+    def to_dataframe(self):
+        # for poking at the data by hand. pandas is only imported if this is ever called.
+        import pandas as pd
+        return pd.DataFrame({name: list(column) for name, column in self.columns.items()})
+
+
+def read_csv_columns(csv_path, record_type):
+    columns = {name: [] for name in record_type.columns}
+    with open(csv_path, newline="", encoding="utf-8-sig") as f:
+        reader = csv.DictReader(f)
+        missing = [name for name in record_type.columns if name not in (reader.fieldnames or [])]
+        if missing:
+            raise ValueError(f"{csv_path} has no {', '.join(missing)} column")
+        for line_number, row in enumerate(reader, start=2):
+            for name, kind in record_type.columns.items():
+                text = row[name]
+                if kind == "str":
+                    columns[name].append(text if text else record_type.blank)
+                elif kind == "float":
+                    columns[name].append(float(text) if text else math.nan)
+                elif text:
+                    columns[name].append(int(float(text)))
+                else:
+                    raise ValueError(f"{csv_path} line {line_number} has no {name}")
+    for name, kind in record_type.columns.items():
+        if kind != "str":
+            columns[name] = array(array_types[kind], columns[name])
+    return columns
+
+
+def write_store(path, source, table):
+    # one line of JSON describing the columns (and holding every distinct string), then the raw column arrays.
+    string_numbers = {}
+    header_columns = []
+    blobs = []
+    for name, kind in table.record_type.columns.items():
+        column = table.columns[name]
+        if kind == "str":
+            column = array("i", [-1 if value is None else string_numbers.setdefault(value, len(string_numbers))
+                                 for value in column])
+        blobs.append(column.tobytes())
+        header_columns.append({"name": name, "type": kind, "bytes": len(blobs[-1])})
+    header = {"version": store_version, "source": source, "byteorder": sys.byteorder, "columns": header_columns,
+              "strings": list(string_numbers)}
+
+    with replaced_atomically(path, "wb") as f:
+        f.write(json.dumps(header).encode("utf-8") + b"\n")
+        for blob in blobs:
+            f.write(blob)
+
+
+def read_store(path, source, record_type):
+    # returns the table, or None if the store is missing, out of date or unreadable.
+    try:
+        with open(path, "rb") as f:
+            header = json.loads(f.readline())
+            if header["version"] != store_version or header["source"] != source:
+                return None
+            if [column["name"] for column in header["columns"]] != list(record_type.columns):
+                return None
+            strings = header["strings"]
+            columns = {}
+            for column in header["columns"]:
+                blob = f.read(column["bytes"])
+                if len(blob) != column["bytes"]:
+                    return None  # cut short
+                numbers = array(array_types[column["type"]])
+                numbers.frombytes(blob)
+                if header["byteorder"] != sys.byteorder:
+                    numbers.byteswap()
+                if column["type"] == "str":
+                    columns[column["name"]] = [record_type.blank if n < 0 else strings[n] for n in numbers]
+                else:
+                    columns[column["name"]] = numbers
+    except (OSError, ValueError, KeyError, TypeError, IndexError):
+        return None
+    return Table(record_type, columns)
+
+
+def load_table(csv_path, record_type, path=store_path):
+    # the CSV as a Table, from the compact copy if it is up to date, otherwise from the CSV (updating the copy).
+    stat = os.stat(csv_path)
+    source = {"path": os.path.abspath(csv_path), "size": stat.st_size, "mtime": stat.st_mtime_ns}
+    store_file = os.path.join(path, os.path.splitext(os.path.basename(csv_path))[0] + ".bin")
+
+    table = read_store(store_file, source, record_type)
+    if table is None:
+        table = Table(record_type, read_csv_columns(csv_path, record_type))
+        try:
+            write_store(store_file, source, table)
+        except OSError:
+            pass  # e.g. a read only folder - the CSV just gets read every time
+    return table
+
+
+def load_questions(csv_path="data.csv"):
+    return load_table(csv_path, Question)
+
+
+def load_topics(csv_path="topics_list.csv"):
+    return load_table(csv_path, Topic)
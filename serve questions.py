@@ -0,0 +1,289 @@
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from collections import OrderedDict
+from urllib.parse import urlsplit, parse_qs, unquote
+import argparse
+import threading
+import json
+import sys
+import io
+import os
+
+from file_tools import load_script
+
+# A small local web server that cuts question and markscheme images straight out of the pdfs when they are asked for,
+# so nothing has to be sliced in advance:
+#   /<paper>/<qNum>/q and /<paper>/<qNum>/a - the stamped question or markscheme as a JPEG, e.g.
+#       /2014MayComputer_science_paper_1_HL/8/q  (add ?width=0 for full size, default is the HTML export width)
+#   /topics - every subtopic with its number of questions, as JSON
+#   /questions?subtopic=...&subtopic=... - the questions filter_data picks for those subtopics, as JSON
+#       (add &collapse=1 to leave out repeated questions, see collapse_repeats in "3 build papers.py". This needs
+#       the server started with --collapse-repeats, and only spots repeats among questions that have been sliced by
+#       "2 slice questions.py" - it compares the slice images, so a question that was never sliced is always kept)
+#   /stats - how the caches are doing
+# Rendered pages and finished images are kept in memory, least recently used first out, up to a size limit.
+# data.csv is read once at start up, so restart the server after changing it.
+
+repo_path = os.path.dirname(os.path.abspath(__file__))
+page_cache_limit = 512 * 1024 * 1024  # bytes - rendered pdf pages, about 11 MB each at 200 dpi
+slice_cache_limit = 64 * 1024 * 1024  # bytes - finished JPEGs, what most repeat requests are for
+render_workers = os.cpu_count() or 1  # requests rendering and encoding at once, the rest wait their turn
+
+
+sys.path.insert(0, repo_path)
+slicer = load_script("2 slice questions.py", "slice_questions")
+builder = load_script("3 build papers.py", "build_papers")
+
+
+class ByteLimitedCache:
+    # a least recently used cache that counts the size of what it holds, not how many things.
+    # Safe to share between request threads.
+    def __init__(self, limit):
+        self.limit = limit
+        self.items = OrderedDict()  # key -> (value, size), least recently used first
+        self.total = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        self.key_locks = {}  # so two requests for the same missing thing make it once, see get_or_make
+
+    def get(self, key):
+        with self.lock:
+            if key not in self.items:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.items.move_to_end(key)
+            return self.items[key][0]
+
+    def put(self, key, value, size):
+        with self.lock:
+            if key in self.items:
+                self.total -= self.items.pop(key)[1]
+            if size > self.limit:
+                return  # would push everything else out and still not fit
+            self.items[key] = (value, size)
+            self.total += size
+            while self.total > self.limit:
+                old_value, old_size = self.items.popitem(last=False)[1]
+                self.total -= old_size
+
+    def get_or_make(self, key, make, size_of):
+        value = self.get(key)
+        if value is not None:
+            return value
+        with self.lock:
+            key_lock = self.key_locks.setdefault(key, threading.Lock())
+        try:
+            with key_lock:
+                value = self.get(key)  # someone else may have made it while we waited
+                if value is None:
+                    value = make()
+                    self.put(key, value, size_of(value))
+        finally:
+            with self.lock:
+                self.key_locks.pop(key, None)
+        return value
+
+    def summary(self):
+        with self.lock:
+            return {"items": len(self.items), "bytes": self.total, "limit": self.limit, "hits": self.hits,
+                    "misses": self.misses}
+
+
+page_cache = ByteLimitedCache(page_cache_limit)
+slice_cache = ByteLimitedCache(slice_cache_limit)
+render_slots = threading.BoundedSemaphore(render_workers)
+
+
+class CachedPaperPages(slicer.PaperPages):
+    # the slicer's PaperPages (same coordinates, same crops), but rendered pages go into the shared page cache
+    # instead of being dropped as slicing moves down the paper - requests come in any order.
+    def __init__(self, path_to_file, mtime):
+        self.lock = threading.Lock()  # one render of a paper at a time, so no page is rendered twice at once
+        self.key = (path_to_file, mtime)
+        super().__init__(path_to_file)
+
+    def get_pages(self, first_page, last_page):
+        with self.lock:
+            pages = {n: page_cache.get((self.key, n)) for n in range(first_page, last_page + 1)}
+            missing = [n for n, page in pages.items() if page is None]
+            if missing:
+                self.pages = {}
+                self.render_pages(missing[0], missing[-1])  # one poppler call for the whole missing run
+                for n, page in self.pages.items():
+                    page_cache.put((self.key, n), page, page.width * page.height * len(page.getbands()))
+                    pages[n] = page
+                self.pages = {}
+        return [pages[n] for n in range(first_page, last_page + 1)]
+
+    def release_pages_before(self, page_number):
+        pass  # pages stay in the page cache until it needs the room
+
+
+open_papers = {}  # pdf path -> CachedPaperPages, only its page count and size - the pages are in page_cache
+open_papers_lock = threading.Lock()
+
+
+def open_paper(path):
+    # raises FileNotFoundError if there is no such pdf.
+    mtime = os.stat(path).st_mtime_ns
+    with open_papers_lock:
+        pages = open_papers.get(path)
+    if pages is None or pages.key[1] != mtime:
+        pages = CachedPaperPages(path, mtime)  # reads the page count and renders the first page
+        with open_papers_lock:
+            open_papers[path] = pages
+    return pages
+
+
+class QuestionServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, questions, topics, collapse_repeats=False):
+        super().__init__(address, QuestionRequestHandler)
+        self.index = builder.QuestionIndex(questions, topics)
+        self.collapse_repeats = collapse_repeats  # whether the slices were hashed at start up, for &collapse=1
+        # "2014MayComputer_science_paper_1_HL" -> {qNum: its first row in data.csv}
+        self.questions_by_paper = {}
+        for question in questions:
+            if question.paper is None:
+                continue
+            paper_questions = self.questions_by_paper.setdefault(slicer.hash_paper_address(question.paper), {})
+            paper_questions.setdefault(question.qNum, question)
+
+    def make_image(self, question, question_or_answer, width):
+        # what slicing then exporting would have made, cut from the pdf there and then. Returns JPEG bytes,
+        # or None if the question has no boundary for it. Raises FileNotFoundError if the pdf is missing.
+        if question_or_answer == "q":
+            pdf, start, end = question.paper, question.scrollLocation, question.scrollLocation_end
+        else:
+            pdf = question.paper.replace(".pdf", "_markscheme.pdf")
+            start, end = question.scrollLocationMS, question.scrollLocationMS_end
+        path = os.path.join(slicer.papers_path, pdf)
+        key = (path, os.stat(path).st_mtime_ns, question.qNum, question_or_answer, width)
+
+        def make():
+            with render_slots:
+                try:
+                    pages = open_paper(path)
+                except slicer.PDFPageCountError:
+                    raise FileNotFoundError(path)
+                try:
+                    img = pages.crop(start * pages.total_height, end * pages.total_height)
+                except ValueError:
+                    return b""  # no boundary, remembered as such so it isn't tried again
+                img = builder.stamp_image(img, builder.generate_slice_info(question.paper, question.qNum,
+                                                                     question_or_answer))
+                if width:
+                    new_width = min(width, img.width)
+                    img = img.resize((new_width, max(1, int(img.height * new_width / img.width))))
+                image_file = io.BytesIO()
+                img.save(image_file, "JPEG", quality=builder.jpeg_quality)
+                return image_file.getvalue()
+
+        return slice_cache.get_or_make(key, make, len) or None
+
+
+class QuestionRequestHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        url = urlsplit(self.path)
+        parts = [unquote(part) for part in url.path.split("/") if part]
+        query = parse_qs(url.query)
+        try:
+            if parts == ["topics"]:
+                self.send_topics()
+            elif parts == ["questions"]:
+                self.send_questions(query.get("subtopic", []), query.get("collapse", ["0"])[0] == "1")
+            elif parts == ["stats"]:
+                self.send_json({"page_cache": page_cache.summary(), "slice_cache": slice_cache.summary(),
+                                "open_papers": len(open_papers)})
+            elif len(parts) == 3 and parts[2] in ("q", "a"):
+                self.send_image(parts[0], parts[1], parts[2], query.get("width", [builder.html_image_width])[0])
+            else:
+                self.send_error(404, "Try /topics, /questions?subtopic=... or /<paper>/<qNum>/q")
+        except BrokenPipeError:
+            pass  # the browser gave up waiting, nothing to tell it
+
+    def send_json(self, data):
+        body = json.dumps(data).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_topics(self):
+        index = self.server.index
+        topics = [{"link_id": topic.link_id, "number": topic.number, "topic": topic.topic, "subtopic": topic.subtopic,
+                   "questions": index.subtopic_counts.get(topic.subtopic, 0)} for topic in index.topics]
+        self.send_json(topics)
+
+    def send_questions(self, subtopics, collapse=False):
+        if collapse and not self.server.collapse_repeats:
+            self.send_error(400, "Start the server with --collapse-repeats to use &collapse=1")
+            return
+        chosen_qs = builder.chosen_questions(self.server.index, subtopics, collapse)
+        questions = []
+        for question in chosen_qs:
+            paper_id = slicer.hash_paper_address(question.paper)
+            questions.append({"paper": question.paper, "qNum": question.qNum,
+                              "question_type": question.question_type, "question": f"/{paper_id}/{question.qNum}/q",
+                              "markscheme": f"/{paper_id}/{question.qNum}/a"})
+        self.send_json(questions)
+
+    def send_image(self, paper_id, qnum, question_or_answer, width):
+        try:
+            width = int(width)
+            if width < 0:
+                raise ValueError
+        except ValueError:
+            self.send_error(400, f"Invalid width {width!r}, it should be a number of pixels (0 for full size)")
+            return
+        try:
+            question = self.server.questions_by_paper.get(paper_id, {}).get(int(qnum))
+        except ValueError:
+            question = None
+        if question is None:
+            self.send_error(404, f"No question {qnum} in {paper_id}")
+            return
+        try:
+            image = self.server.make_image(question, question_or_answer, width)
+        except FileNotFoundError:
+            self.send_error(404, f"The pdf for {paper_id} isn't in {slicer.papers_path}")
+            return
+        if image is None:
+            self.send_error(404, f"Question {qnum} in {paper_id} has no boundary for this")
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", "image/jpeg")
+        self.send_header("Content-Length", str(len(image)))
+        self.send_header("Cache-Control", "max-age=300")
+        self.end_headers()
+        self.wfile.write(image)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve question and markscheme images cut from the pdfs on demand.")
+    parser.add_argument("--host", default="127.0.0.1", help="address to listen on (default: %(default)s)")
+    parser.add_argument("--port", type=int, default=8000, help="port to listen on (default: %(default)s)")
+    parser.add_argument("--page-cache-mb", type=int, default=page_cache_limit // 1024 // 1024,
+                        help="memory for rendered pdf pages (default: %(default)s)")
+    parser.add_argument("--slice-cache-mb", type=int, default=slice_cache_limit // 1024 // 1024,
+                        help="memory for finished images (default: %(default)s)")
+    parser.add_argument("--collapse-repeats", action="store_true",
+                        help="hash the slices in _User files/images at start up, so /questions can take &collapse=1. "
+                             "Only questions that have been sliced can be spotted as repeats")
+    args = parser.parse_args()
+    page_cache.limit = args.page_cache_mb * 1024 * 1024
+    slice_cache.limit = args.slice_cache_mb * 1024 * 1024
+
+    if args.collapse_repeats:
+        builder.load_slice_hashes()  # here, before any request threads start
+    server = QuestionServer((args.host, args.port), builder.load_data_from_csv(), builder.load_topics_from_csv(),
+                            args.collapse_repeats)
+    print(f"Serving questions on http://{args.host}:{args.port}/topics - Ctrl+C to stop.")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()